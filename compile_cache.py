@@ -0,0 +1,115 @@
+"""
+Ahead-of-time compilation of FastDVDnet models with an on-disk cache.
+
+A model is traced and frozen with TorchScript for a given input resolution. The
+compiled artifact is stored in a local cache directory, keyed by a hash of the
+weights, the resolution, the device type and the PyTorch version, so that later
+runs load it instead of tracing the model again.
+
+This program is free software: you can use, modify and/or
+redistribute it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either
+version 3 of the License, or (at your option) any later
+version. You should have received a copy of this license along
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import copy
+import hashlib
+import weakref
+import torch
+from models import fold_noise_map
+from fastdvdnet import unwrap_model, get_num_input_frames, get_exp_padding
+
+COMPILE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'fastdvdnet')
+WEIGHTS_HASHES = weakref.WeakKeyDictionary() # hashes of the weights of the models seen so far
+COMPILED_MODELS = {} # compiled models loaded by this process, by cache file
+
+def weights_hash(model):
+	r"""Returns a hash of the parameters and buffers of model (names and values).
+	It is computed once per model instance, which must not be trained afterwards.
+	"""
+	model = unwrap_model(model)
+	if model not in WEIGHTS_HASHES:
+		sha = hashlib.sha256()
+		for name, tensor in model.state_dict().items():
+			sha.update(name.encode('utf-8'))
+			sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+		WEIGHTS_HASHES[model] = sha.hexdigest()[:16]
+	return WEIGHTS_HASHES[model]
+
+def get_memory_format(model):
+	r"""Returns 'channels_last' if the convolution weights of model are stored in the
+	channels_last memory format (see fastdvdnet.prepare_cpu_inference()), else 'contiguous'
+	"""
+	for param in unwrap_model(model).parameters():
+		if param.dim() == 4:
+			if hasattr(torch, 'channels_last') and not param.is_contiguous() and \
+			   param.is_contiguous(memory_format=torch.channels_last):
+				return 'channels_last'
+			break
+	return 'contiguous'
+
+def get_cache_key(model, height, width, device):
+	r"""Returns the key of the compiled artifact of model for inputs of spatial size
+	height x width (before padding to a multiple of four) on device
+	"""
+	padexp = get_exp_padding((height, width))
+	return '{}_{}x{}_{}_{}_torch{}'.format(weights_hash(model), \
+										   height+padexp[3], width+padexp[1], \
+										   torch.device(device).type, get_memory_format(model), \
+										   torch.__version__.replace('+', '_'))
+
+def compile_model(model, height, width, device, num_channels=3):
+	r"""Traces and freezes model with TorchScript for inputs of spatial size
+	height x width (already padded to a multiple of four). A copy of model is traced,
+	model itself is left unchanged.
+	"""
+	if not hasattr(torch.jit, 'freeze'):
+		raise Exception('Compiling models needs torch>=1.8, found {}'.format(torch.__version__))
+	# noise map folding depends on the data, trace the plain model
+	model = fold_noise_map(copy.deepcopy(unwrap_model(model)), enable=False).eval().to(device)
+	temp_psz = get_num_input_frames(model)
+	example_inputs = (torch.rand((1, temp_psz*num_channels, height, width), device=device), \
+					  torch.rand((1, 1, height, width), device=device))
+	with torch.no_grad():
+		compiled = torch.jit.trace(model, example_inputs)
+	return torch.jit.freeze(compiled)
+
+def load_or_compile(model, height, width, device, cache_dir=COMPILE_CACHE_DIR, num_channels=3):
+	r"""Returns the compiled version of model for inputs of spatial size height x width,
+	loading it from cache_dir if it was compiled before. Compiled models are also kept
+	in memory, so that each artifact is loaded once per process.
+
+	Args:
+		model: FastDVDnet instance (possibly wrapped by nn.DataParallel) with its
+			trained weights loaded
+		height, width: spatial size of the frames to denoise
+		device: torch.device where the model runs
+		cache_dir: path of the directory of the compiled artifacts
+		num_channels: number of color channels of the frames
+	Returns:
+		compiled: torch.jit.ScriptModule. It has no 'num_input_frames' attribute,
+			pass temp_psz to the denoising functions.
+	"""
+	key = get_cache_key(model, height, width, device)
+	cache_file = os.path.join(cache_dir, key + '.pt')
+	if cache_file in COMPILED_MODELS:
+		return COMPILED_MODELS[cache_file]
+	if os.path.isfile(cache_file):
+		print('\tLoading compiled model {}'.format(cache_file))
+		COMPILED_MODELS[cache_file] = torch.jit.load(cache_file, map_location=device)
+		return COMPILED_MODELS[cache_file]
+
+	print('\tCompiling model for resolution {}x{} ...'.format(height, width))
+	padexp = get_exp_padding((height, width))
+	compiled = compile_model(model, height+padexp[3], width+padexp[1], device, num_channels)
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+	# write to a temporary file first so that concurrent jobs never read partial files
+	tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+	torch.jit.save(compiled, tmp_file)
+	os.replace(tmp_file, cache_file)
+	COMPILED_MODELS[cache_file] = compiled
+
+	return compiled
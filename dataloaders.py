@@ -5,12 +5,27 @@ and decodes H264 video codec with FFmpeg.
 
 Based on
 https://github.com/NVIDIA/DALI/blob/master/docs/examples/video/superres_pytorch/dataloading/dataloaders.py
+
+It also implements train_cpu_loader, a dataloader with the same interface which decodes the
+sequences on CPU worker processes with OpenCV, for machines without CUDA or DALI.
 '''
 import os
-from nvidia.dali.pipeline import Pipeline
-from nvidia.dali.plugin import pytorch
-import nvidia.dali.ops as ops
-import nvidia.dali.types as types
+import inspect
+import cv2
+import torch
+from torch.utils.data import Dataset, DataLoader, RandomSampler
+from utils import get_imagenames
+from video_io import VIDEOEXT
+try:
+	from nvidia.dali.pipeline import Pipeline
+	from nvidia.dali.plugin import pytorch
+	import nvidia.dali.ops as ops
+	import nvidia.dali.types as types
+	DALI_AVAILABLE = True
+except ImportError:
+	# only train_cpu_loader can be used
+	Pipeline = object
+	DALI_AVAILABLE = False
 
 class VideoReaderPipeline(Pipeline):
 	''' Pipeline for reading H264 videos based on NVIDIA DALI.
@@ -78,13 +93,16 @@ class train_dali_loader():
 		epoch_size: (int, optional, default=-1)
 			Size of the epoch. If epoch_size <= 0, epoch_size will default to the size of VideoReaderPipeline
 		random_shuffle (bool, optional, default=True)
-			Whether to randomly shuffle data.
+			Whether to randomly shuffle data. If False, each epoch draws epoch_size
+			samples from the sequences in order.
 		temp_stride: (int, optional, default=-1)
 			Frame interval between each sequence
 			(if `temp_stride` < 0, `temp_stride` is set to `sequence_length`).
 	'''
 	def __init__(self, batch_size, file_root, sequence_length, \
 				 crop_size, epoch_size=-1, random_shuffle=True, temp_stride=-1):
+		if not DALI_AVAILABLE:
+			raise Exception('NVIDIA DALI is not installed, use train_cpu_loader instead')
 		# Builds list of sequence filenames
 		container_files = os.listdir(file_root)
 		container_files = [file_root + '/' + f for f in container_files]
@@ -115,3 +133,134 @@ class train_dali_loader():
 
 	def __iter__(self):
 		return self.dali_iterator.__iter__()
+
+class TrainSequenceDataset(Dataset):
+	'''Dataset of the training sequences of `sequence_length` frames of the video files
+	and image-sequence folders under file_root. Sequences start every `temp_stride` frames
+	of each video (or folder). Items are random crops of size crop_size (in the same
+	location in all frames) of shape [F, C, H, W]. Frames are RGB uint8.
+	'''
+	def __init__(self, file_root, sequence_length, crop_size, temp_stride=-1):
+		if temp_stride <= 0:
+			temp_stride = sequence_length
+		self.sequence_length = sequence_length
+		self.crop_size = crop_size
+		self.captures = {} # opened videos of the worker process
+
+		# index the first frame of every sequence
+		self.sources = []
+		self.samples = []
+		for name in sorted(os.listdir(file_root)):
+			path = os.path.join(file_root, name)
+			if os.path.isdir(path):
+				source = get_imagenames(path)
+				num_frames = len(source)
+				if num_frames == 0:
+					continue
+				H, W = cv2.imread(source[0]).shape[:2]
+			elif name.lower().endswith(VIDEOEXT):
+				source = path
+				cap = cv2.VideoCapture(path)
+				num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+				H = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+				W = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+				cap.release()
+			else:
+				continue
+			if crop_size > min(H, W):
+				raise Exception('Crop size {} is larger than the {}x{} frames of {}'.\
+								format(crop_size, H, W, path))
+			for start in range(0, num_frames - sequence_length + 1, temp_stride):
+				self.samples.append((len(self.sources), start))
+			self.sources.append(source)
+		if not self.samples:
+			raise Exception('No sequence of {} frames found under {}'.\
+							format(sequence_length, file_root))
+
+	def read_frames(self, source, start):
+		if isinstance(source, list):
+			return [cv2.imread(fpath) for fpath in source[start:start+self.sequence_length]]
+		# videos are kept open by the worker, and seeked to the first frame
+		if source not in self.captures:
+			self.captures[source] = cv2.VideoCapture(source)
+		cap = self.captures[source]
+		cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+		frames = []
+		for _ in range(self.sequence_length):
+			ret, frame = cap.read()
+			if not ret:
+				raise Exception('Could not read frame {} of {}'.format(start+len(frames), source))
+			frames.append(frame)
+		return frames
+
+	def __getitem__(self, index):
+		src_idx, start = self.samples[index]
+		frames = self.read_frames(self.sources[src_idx], start)
+
+		# random crop, in the same location in all frames
+		H, W = frames[0].shape[:2]
+		top = int(torch.randint(H - self.crop_size + 1, (1,)))
+		left = int(torch.randint(W - self.crop_size + 1, (1,)))
+		seq = torch.empty((self.sequence_length, 3, self.crop_size, self.crop_size), \
+						  dtype=torch.uint8)
+		for fridx, frame in enumerate(frames):
+			crop = frame[top:top+self.crop_size, left:left+self.crop_size]
+			seq[fridx] = torch.from_numpy(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB).transpose(2, 0, 1))
+		return seq
+
+	def __len__(self):
+		return len(self.samples)
+
+class train_cpu_loader():
+	'''Sequence dataloader decoding on CPU, with the same interface as train_dali_loader.
+	Iterating over it yields [{'data': batch}], with batch a float Tensor of shape
+	[N, F, C, H, W] in the range [0., 255.]. The sequences are decoded by num_workers
+	processes and the batches are sent to the main process through shared memory.
+	Args:
+		batch_size: (int)
+			Size of the batches
+		file_root: (str)
+			Path to directory with video sequences (files) or image sequences (folders)
+		sequence_length: (int)
+			Frames to load per sequence
+		crop_size: (int)
+			Size of the crops. The crops are in the same location in all frames in the sequence
+		epoch_size: (int, optional, default=-1)
+			Size of the epoch. If epoch_size <= 0, epoch_size will default to the number of sequences
+		random_shuffle (bool, optional, default=True)
+			Whether to randomly shuffle data. If False, each epoch draws epoch_size
+			samples from the sequences in order.
+		temp_stride: (int, optional, default=-1)
+			Frame interval between each sequence
+			(if `temp_stride` < 0, `temp_stride` is set to `sequence_length`).
+		num_workers: (int, optional, default=4)
+			Number of decoding processes
+	'''
+	def __init__(self, batch_size, file_root, sequence_length, \
+				 crop_size, epoch_size=-1, random_shuffle=True, temp_stride=-1, num_workers=4):
+		self.dataset = TrainSequenceDataset(file_root, sequence_length, crop_size, temp_stride)
+
+		# Define size of epoch
+		if epoch_size <= 0:
+			self.epoch_size = len(self.dataset)
+		else:
+			self.epoch_size = epoch_size
+		if random_shuffle:
+			sampler = RandomSampler(self.dataset, replacement=True, num_samples=self.epoch_size)
+		else:
+			# the sequences in order, cycling over them until epoch_size samples are drawn
+			sampler = [idx % len(self.dataset) for idx in range(self.epoch_size)]
+		# prefetch_factor is only accepted with worker processes by torch<2.0, and
+		# neither option exists before torch 1.7
+		worker_args = {}
+		if num_workers > 0 and 'persistent_workers' in inspect.signature(DataLoader).parameters:
+			worker_args = {'persistent_workers': True, 'prefetch_factor': 4}
+		self.loader = DataLoader(self.dataset, batch_size=batch_size, sampler=sampler, \
+								 num_workers=num_workers, **worker_args)
+
+	def __len__(self):
+		return self.epoch_size
+
+	def __iter__(self):
+		for batch in self.loader:
+			yield [{'data': batch.float()}]
@@ -12,17 +12,26 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 """
 import os
 import glob
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from torch.utils.data.dataset import Dataset
 from utils import open_sequence
 
 NUMFRXSEQ_VAL = 15	# number of frames of each sequence to include in validation dataset
 VALSEQPATT = '*' # pattern for name of validation sequence
+VALCACHEMB = 1024 # default memory budget (in MB) of the decoded sequences of LazyValDataset
 
 class ValDataset(Dataset):
 	"""Validation dataset. Loads all the images in the dataset folder on memory.
+	With uint8=True, the sequences are stored (and returned) as uint8 Tensors
+	in the range [0, 255], see fastdvdnet.frames_to_float(). If cache_dir is not
+	None, the decoded sequences are memory-mapped from the frame cache of
+	utils.open_sequence().
 	"""
-	def __init__(self, valsetdir=None, gray_mode=False, num_input_frames=NUMFRXSEQ_VAL):
+	def __init__(self, valsetdir=None, gray_mode=False, num_input_frames=NUMFRXSEQ_VAL, \
+				 uint8=False, cache_dir=None):
 		self.gray_mode = gray_mode
 
 		# Look for subdirs with individual sequences
@@ -32,7 +41,7 @@ class ValDataset(Dataset):
 		sequences = []
 		for seq_dir in seqs_dirs:
 			seq, _, _ = open_sequence(seq_dir, gray_mode, expand_if_needed=False, \
-							 max_num_fr=num_input_frames)
+							 max_num_fr=num_input_frames, uint8=uint8, cache_dir=cache_dir)
 			# seq is [num_frames, C, H, W]
 			sequences.append(seq)
 
@@ -43,3 +52,86 @@ class ValDataset(Dataset):
 
 	def __len__(self):
 		return len(self.sequences)
+
+class LazyValDataset(Dataset):
+	"""Validation dataset which decodes the sequences on demand. Only the paths of
+	the sequences are indexed up front. The decoded sequences are kept in an LRU
+	cache bounded by max_bytes (the last accessed sequence is always kept), and
+	the next sequence can be decoded in a background thread while the current one
+	is used. The prefetched sequence counts towards max_bytes as soon as it is
+	decoded. Items are the same as the ones of ValDataset.
+	"""
+	def __init__(self, valsetdir=None, gray_mode=False, num_input_frames=NUMFRXSEQ_VAL, \
+				 uint8=False, cache_dir=None, max_bytes=VALCACHEMB*2**20, prefetch=True):
+		self.gray_mode = gray_mode
+		self.num_input_frames = num_input_frames
+		self.uint8 = uint8
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+
+		# Look for subdirs with individual sequences
+		self.seqs_dirs = sorted(glob.glob(os.path.join(valsetdir, VALSEQPATT)))
+
+		self.sequences = OrderedDict() # decoded sequences, least recently used first
+		self.num_bytes = 0 # of the cached and the prefetched sequences
+		self.lock = threading.Lock()
+		self.pending = {} # index -> Future of the sequences being prefetched
+		self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+	def load(self, index):
+		seq, _, _ = open_sequence(self.seqs_dirs[index], self.gray_mode, expand_if_needed=False, \
+						 max_num_fr=self.num_input_frames, uint8=self.uint8, \
+						 cache_dir=self.cache_dir)
+		return torch.from_numpy(seq)
+
+	def evict(self):
+		# evict the least recently used sequences over budget, called with the lock held
+		while self.num_bytes > self.max_bytes and len(self.sequences) > 1:
+			_, old = self.sequences.popitem(last=False)
+			self.num_bytes -= old.numel() * old.element_size()
+
+	def insert(self, index, seq, counted=False):
+		# add seq to the cache (its size is already counted if it was prefetched)
+		with self.lock:
+			if index not in self.sequences:
+				self.sequences[index] = seq
+				if not counted:
+					self.num_bytes += seq.numel() * seq.element_size()
+			elif counted:
+				# already cached, the prefetched copy is dropped
+				self.num_bytes -= seq.numel() * seq.element_size()
+			self.sequences.move_to_end(index)
+			self.evict()
+
+	def load_prefetched(self, index):
+		# decode in the background and make room for the sequence in the budget
+		seq = self.load(index)
+		with self.lock:
+			self.num_bytes += seq.numel() * seq.element_size()
+			self.evict()
+		return seq
+
+	def prefetch(self, index):
+		with self.lock:
+			if index in self.sequences or index in self.pending:
+				return
+			self.pending[index] = self.executor.submit(self.load_prefetched, index)
+
+	def __getitem__(self, index):
+		with self.lock:
+			seq = self.sequences.get(index)
+			future = self.pending.pop(index, None)
+		if future is not None:
+			# the prefetched sequence is counted in the budget once decoded
+			prefetched = future.result()
+			seq = prefetched if seq is None else seq
+		elif seq is None:
+			seq = self.load(index)
+		self.insert(index, seq, counted=future is not None)
+
+		if self.executor is not None and len(self) > 1:
+			self.prefetch((index + 1) % len(self))
+		return seq
+
+	def __len__(self):
+		return len(self.seqs_dirs)
@@ -3,75 +3,648 @@ FastDVDnet denoising algorithm
 
 @author: Matias Tassano <mtassano@parisdescartes.fr>
 """
+import os
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
 import torch.nn.functional as F
+from models import FastDVDnet, noise_level
+SHARD_WORKER_MODEL = None # model of a worker process of denoise_seq_sharded()
 
-def temp_denoise(model, noisyframe, sigma_noise):
-	'''Encapsulates call to denoising model and handles padding.
-		Expects noisyframe to be normalized in [0., 1.]
+def frames_to_float(frames):
+	'''Converts uint8 frames in the range [0, 255] to float32 in the range [0, 1].
+		Float frames are returned unchanged
+	'''
+	if frames.dtype == torch.uint8:
+		return frames.float().div_(255.)
+	return frames
+
+def get_exp_padding(sh_im):
+	'''Returns the padding (as expected by F.pad) needed to make the spatial size
+		of a tensor of shape sh_im a multiple of four (we have two scales in the denoiser)
 	'''
-	# make size a multiple of four (we have two scales in the denoiser)
-	sh_im = noisyframe.size()
 	expanded_h = sh_im[-2]%4
 	if expanded_h:
 		expanded_h = 4-expanded_h
 	expanded_w = sh_im[-1]%4
 	if expanded_w:
 		expanded_w = 4-expanded_w
-	padexp = (0, expanded_w, 0, expanded_h)
-	noisyframe = F.pad(input=noisyframe, pad=padexp, mode='reflect')
-	sigma_noise = F.pad(input=sigma_noise, pad=padexp, mode='reflect')
-    # denoise
-	out = torch.clamp(model(noisyframe, sigma_noise), 0., 1.)
+	return (0, expanded_w, 0, expanded_h)
 
+def crop_exp_padding(out, padexp):
+	'''Removes the padding added according to get_exp_padding()
+	'''
+	expanded_w = padexp[1]
+	expanded_h = padexp[3]
 	if expanded_h:
 		out = out[:, :, :-expanded_h, :]
 	if expanded_w:
 		out = out[:, :, :, :-expanded_w]
-
 	return out
 
-def denoise_seq_fastdvdnet(seq, noise_std, temp_psz, model_temporal):
+def reflect_index(idx, numframes):
+	'''Handles border conditions of the temporal window by reflecting
+		the frame index idx at both ends of a sequence of numframes frames.
+		Indices reflected more than once (sequences shorter than half the
+		temporal window) are not supported
+	'''
+	ref_idx = abs(idx)
+	ref_idx = min(ref_idx, 2*(numframes-1)-ref_idx)
+	if ref_idx < 0 or ref_idx >= numframes:
+		raise Exception('Cannot reflect frame index {} in a sequence of {} frames, the sequence '\
+						'is too short for the temporal window'.format(idx, numframes))
+	return ref_idx
+
+def unwrap_model(model):
+	'''Returns the model wrapped by nn.DataParallel, if any
+	'''
+	if isinstance(model, nn.DataParallel):
+		return model.module
+	return model
+
+def get_num_input_frames(model):
+	'''Returns the size of the temporal window of a FastDVDnet model
+	'''
+	model = unwrap_model(model)
+	if not hasattr(model, 'num_input_frames'):
+		raise Exception('Cannot infer the temporal patch size of {}, pass temp_psz'.\
+						format(type(model).__name__))
+	return model.num_input_frames
+
+def cpu_supports_bf16():
+	'''Returns True if the CPU has native bfloat16 support usable by oneDNN
+	'''
+	try:
+		return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+	except (AttributeError, RuntimeError):
+		return False
+
+def cpu_autocast(enabled, dtype=None):
+	'''Returns a CPU autocast context (bfloat16 by default) if enabled, a no-op
+		context otherwise, so that torch.autocast (torch>=1.10) is only needed
+		when it is used
+	'''
+	if not enabled:
+		return contextlib.ExitStack()
+	return torch.autocast('cpu', dtype=torch.bfloat16 if dtype is None else dtype)
+
+def prepare_cpu_inference(model):
+	r"""Prepares a model for fast CPU inference: converts the weights to the
+	channels_last memory format. Inputs are converted to channels_last when running
+	denoise_seq_fastdvdnet() with channels_last=True. The model is modified in place
+	and returned.
+	"""
+	return model.to(memory_format=torch.channels_last)
+
+def get_tile_positions(size, tile_size, tile_overlap):
+	'''Returns the start positions of the tiles of length tile_size covering
+		a dimension of length size, with at least tile_overlap overlap
+	'''
+	if size <= tile_size:
+		return [0]
+	positions = list(range(0, size-tile_size, tile_size-tile_overlap))
+	positions.append(size-tile_size)
+	return positions
+
+def get_tile_weights(start, length, size, tile_overlap):
+	'''Returns the 1D blending weights of a tile: linear ramps over the overlap
+		regions shared with the neighbouring tiles, ones elsewhere
+	'''
+	weights = torch.ones(length)
+	if tile_overlap > 0:
+		ramp = torch.arange(1, tile_overlap+1, dtype=torch.float32) / (tile_overlap+1)
+		if start > 0:
+			weights[:tile_overlap] = ramp
+		if start+length < size:
+			weights[-tile_overlap:] = ramp.flip(0)
+	return weights
+
+def tiled_apply(model, inputs, tile_size, tile_overlap=16, num_workers=1):
+	r"""Applies a denoising model on overlapping spatial tiles of its inputs and
+	blends the results.
+
+	The peak memory used by the model scales with the tile size instead of the frame
+	size. Tile sizes and positions are kept multiple of four (we have two scales in
+	the denoiser), hence the inputs must already be padded to a multiple of four
+	(see get_exp_padding()). The overlap regions are linearly blended.
+
+	Args:
+		model: callable taking the tensors in inputs as arguments, e.g. a FastDVDnet
+			or a DenBlock instance
+		inputs: tuple of Tensors of dims [N, *, H, W], tiled in the same way
+		tile_size: int, spatial size of the tiles
+		tile_overlap: int, minimum overlap between neighbouring tiles
+		num_workers: number of tiles processed concurrently in a thread pool
+	Returns:
+		out: Tensor, [N, C, H, W]
+	"""
+	N, _, H, W = inputs[0].shape
+	if H%4 or W%4:
+		raise Exception('Tiled inference needs inputs padded to a multiple of four, got {}x{}'.\
+						format(H, W))
+	tile_size = max(tile_size - tile_size%4, 4)
+	tile_overlap = max(min(tile_overlap - tile_overlap%4, tile_size-4), 0)
+	tile_h = min(tile_size, H)
+	tile_w = min(tile_size, W)
+	tiles = [(top, left) for top in get_tile_positions(H, tile_h, tile_overlap) \
+			 for left in get_tile_positions(W, tile_w, tile_overlap)]
+
+	# grad mode and CPU autocast are thread-local: propagate the ones of the caller to
+	# the worker threads, otherwise each tile would keep its autograd graph alive
+	grad_enabled = torch.is_grad_enabled()
+	autocast_cpu = hasattr(torch, 'is_autocast_cpu_enabled') and torch.is_autocast_cpu_enabled()
+	autocast_dtype = torch.get_autocast_cpu_dtype() if autocast_cpu else None
+
+	def run_tile(pos):
+		top, left = pos
+		with torch.set_grad_enabled(grad_enabled), cpu_autocast(autocast_cpu, autocast_dtype):
+			return model(*[inp[:, :, top:top+tile_h, left:left+tile_w] for inp in inputs])
+
+	out = None
+	with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+		results = executor.map(run_tile, tiles) if num_workers > 1 else map(run_tile, tiles)
+		for (top, left), out_tile in zip(tiles, results):
+			if out is None:
+				out = torch.zeros((N, out_tile.size(1), H, W), dtype=out_tile.dtype, \
+								  device=out_tile.device)
+				weights = torch.zeros((1, 1, H, W), dtype=out_tile.dtype, device=out_tile.device)
+			w_tile = get_tile_weights(top, tile_h, H, tile_overlap)[:, None] * \
+					 get_tile_weights(left, tile_w, W, tile_overlap)[None, :]
+			w_tile = w_tile.to(device=out_tile.device, dtype=out_tile.dtype)
+			out[:, :, top:top+tile_h, left:left+tile_w] += out_tile * w_tile
+			weights[:, :, top:top+tile_h, left:left+tile_w] += w_tile
+
+	return out / weights
+
+def run_model(model, inputs, tile_size=None, tile_overlap=16, tile_workers=1):
+	'''Calls model on inputs, on overlapping tiles if tile_size is not None
+	'''
+	if tile_size is None:
+		return model(*inputs)
+	return tiled_apply(model, inputs, tile_size, tile_overlap, tile_workers)
+
+def temp_denoise(model, noisyframe, sigma_noise, tile_size=None, tile_overlap=16, tile_workers=1):
+	'''Encapsulates call to denoising model and handles padding.
+		Expects noisyframe to be normalized in [0., 1.]
+		If tile_size is not None, the model runs on overlapping tiles (see tiled_apply())
+	'''
+	# make size a multiple of four (we have two scales in the denoiser)
+	padexp = get_exp_padding(noisyframe.size())
+	noisyframe = F.pad(input=noisyframe, pad=padexp, mode='reflect')
+	sigma_noise = F.pad(input=sigma_noise, pad=padexp, mode='reflect')
+	# denoise
+	out = run_model(model, (noisyframe, sigma_noise), tile_size, tile_overlap, tile_workers)
+	out = torch.clamp(out, 0., 1.)
+
+	return crop_exp_padding(out, padexp)
+
+def get_window_indices(numframes, temp_psz):
+	r"""Builds the table of frame indices of all the temporal windows of a sequence.
+
+	Args:
+		numframes: number of frames of the sequence
+		temp_psz: size of the temporal patch
+	Returns:
+		idx_table: LongTensor, [numframes, temp_psz]. Row fridx contains the
+			(reflected at the borders) indices of the frames of the window
+			centered at frame fridx
+	"""
+	ctrlfr_idx = int((temp_psz-1)//2)
+	return torch.LongTensor([[reflect_index(fridx+off, numframes) \
+							  for off in range(-ctrlfr_idx, ctrlfr_idx+1)] \
+							 for fridx in range(numframes)])
+
+def denoise_seq_cached(seq, noise_std, temp_psz, model_temporal, batch_size=1, \
+					   tile_size=None, tile_overlap=16, tile_workers=1, channels_last=False, \
+					   frame_callback=None):
+	r"""Denoises a sequence of frames with FastDVDnet reusing the results of the
+	intermediate denoising stages.
+
+	Two consecutive temporal windows share most of their intermediate results, e.g.
+	two of the three first-stage triplets of the 5-frame model. The outputs of every
+	stage but the last one are kept in small caches indexed by the frame indices they
+	depend on, so that each block runs only once per new node and the last stage runs
+	on cached results. The output is the one of denoise_seq_fastdvdnet() up to float
+	rounding: the blocks run on batches of nodes made differently.
+
+	Args:
+		seq: Tensor. [numframes, C, H, W] array containing the noisy input frames
+			(float in [0, 1], or uint8 in [0, 255] converted frame by frame)
+		noise_std: Tensor. Standard deviation of the added noise
+		temp_psz: size of the temporal patch. If None, the one of the model is used
+		model_temporal: instance of the PyTorch FastDVDnet model (possibly wrapped
+			by nn.DataParallel)
+		batch_size: number of output frames computed per call to the last stage
+		tile_size, tile_overlap, tile_workers: if tile_size is not None, each
+			denoising stage runs on overlapping tiles (see tiled_apply())
+		channels_last: if True, the padded sequence is converted to channels_last
+			once (see prepare_cpu_inference())
+		frame_callback: see denoise_seq_fastdvdnet()
+	Returns:
+		denframes: Tensor, [numframes, C, H, W]
+	"""
+	model = unwrap_model(model_temporal)
+	if not isinstance(model, FastDVDnet):
+		raise Exception('Caching intermediate results needs a FastDVDnet model, got {}'.\
+						format(type(model).__name__))
+	if temp_psz is None:
+		temp_psz = model.num_input_frames
+	num_stages = model.num_stages
+
+	numframes, C, H, W = seq.shape
+	denframes = torch.empty((numframes, C, H, W)).to(seq.device)
+	idx_table = get_window_indices(numframes, temp_psz).tolist()
+
+	# pad the whole sequence and the noise map only once
+	padexp = get_exp_padding(seq.size())
+	Hp, Wp = H+padexp[3], W+padexp[1]
+	if seq.dtype == torch.uint8:
+		# uint8 frames are converted and padded when they are gathered
+		seq_pad = seq
+	else:
+		seq_pad = F.pad(input=seq, pad=padexp, mode='reflect')
+		if channels_last:
+			seq_pad = seq_pad.contiguous(memory_format=torch.channels_last)
+	noise_map = F.pad(input=noise_std.expand((1, 1, H, W)), pad=padexp, mode='reflect')
+
+	# outputs of stages 1 to num_stages-1 needed by the current windows, indexed by
+	# the frame indices of the nodes
+	stage_caches = [OrderedDict() for _ in range(num_stages-1)]
+
+	def gather_nodes(stage, keys):
+		# stage 0 are the input frames
+		if stage == 0:
+			if seq_pad.dtype == torch.uint8:
+				frames = F.pad(input=frames_to_float(seq_pad[[key[0] for key in keys]]), \
+							   pad=padexp, mode='reflect')
+				if channels_last:
+					frames = frames.contiguous(memory_format=torch.channels_last)
+				return frames
+			return seq_pad[[key[0] for key in keys]]
+		return torch.cat([stage_caches[stage-1][key] for key in keys], dim=0)
+
+	def run_stage(stage, keys):
+		# denoise the nodes keys of stage from their three children of stage-1
+		num_keys = len(keys)
+		inputs = tuple(gather_nodes(stage-1, [key[m:len(key)-2+m] for key in keys]) \
+					   for m in range(3))
+		return run_model(model.stage_block(stage), \
+						 inputs + (noise_map.expand((num_keys, 1, Hp, Wp)),), \
+						 tile_size, tile_overlap, tile_workers)
+
+	for fridx in range(0, numframes, batch_size):
+		wins_idx = idx_table[fridx:fridx+batch_size]
+		num_wins = len(wins_idx)
+
+		for stage in range(1, num_stages):
+			# nodes of this stage used by the windows of this batch
+			node_len = 2*stage+1
+			needed = [tuple(win_idx[m:m+node_len]) \
+					  for win_idx in wins_idx for m in range(temp_psz-node_len+1)]
+			cache = stage_caches[stage-1]
+
+			# drop the nodes not used by the current windows
+			for key in list(cache.keys()):
+				if key not in needed:
+					del cache[key]
+
+			# run the block of this stage only for new nodes
+			new_keys = list(OrderedDict.fromkeys(key for key in needed if key not in cache))
+			if new_keys:
+				out_stage = run_stage(stage, new_keys)
+				for m, key in enumerate(new_keys):
+					cache[key] = out_stage[m:m+1]
+
+		# last stage
+		out = run_stage(num_stages, [tuple(win_idx) for win_idx in wins_idx])
+		denframes[fridx:fridx+num_wins] = crop_exp_padding(out, padexp).clamp_(0., 1.)
+		if frame_callback is not None:
+			frame_callback(fridx, denframes[fridx:fridx+num_wins])
+
+	# free memory up
+	del stage_caches
+	del seq_pad
+	torch.cuda.empty_cache()
+
+	return denframes
+
+def denoise_seq_fastdvdnet(seq, noise_std, temp_psz, model_temporal, cache_stage1=False, \
+						   batch_size=1, tile_size=None, tile_overlap=16, tile_workers=1, \
+						   channels_last=False, frame_callback=None):
 	r"""Denoises a sequence of frames with FastDVDnet.
 
+	The temporal windows are built from a precomputed table of frame indices and
+	batch_size of them are denoised in each call to the model.
+
 	Args:
-		seq: Tensor. [numframes, 1, C, H, W] array containing the noisy input frames
+		seq: Tensor. [numframes, C, H, W] array containing the noisy input frames,
+			either float in [0, 1] or uint8 in [0, 255]. uint8 frames are converted
+			to float window by window, so that the whole sequence is never stored as float
 		noise_std: Tensor. Standard deviation of the added noise
-		temp_psz: size of the temporal patch
+		temp_psz: size of the temporal patch. If None, the one of the model is used
 		model_temp: instance of the PyTorch model of the temporal denoiser
+		cache_stage1: if True, reuse the intermediate results shared by
+			consecutive windows (see denoise_seq_cached())
+		batch_size: number of temporal windows denoised per call to the model
+		tile_size: if not None, spatial size of the tiles the model runs on (see tiled_apply())
+		tile_overlap: minimum overlap between neighbouring tiles
+		tile_workers: number of tiles processed concurrently
+		channels_last: if True, the inputs of the model are converted to the
+			channels_last memory format (see prepare_cpu_inference())
+		frame_callback: if not None, called as frame_callback(fridx, frames) with each
+			batch of denoised frames [num_frames, C, H, W] starting at frame fridx, as
+			soon as they are computed (e.g. to update metrics, see metrics.StreamingMetrics)
 	Returns:
 		denframes: Tensor, [numframes, C, H, W]
 	"""
+	with noise_level(model_temporal, noise_std):
+		if cache_stage1:
+			return denoise_seq_cached(seq, noise_std, temp_psz, model_temporal, batch_size, \
+									  tile_size, tile_overlap, tile_workers, channels_last, \
+									  frame_callback)
+
+		if temp_psz is None:
+			temp_psz = get_num_input_frames(model_temporal)
+		idx_table = get_window_indices(seq.size(0), temp_psz).to(seq.device)
+
+		return denoise_windows(seq, noise_std, idx_table, model_temporal, batch_size, \
+							   tile_size, tile_overlap, tile_workers, channels_last, frame_callback)
+
+def denoise_windows(seq, noise_std, idx_table, model_temporal, batch_size=1, \
+					tile_size=None, tile_overlap=16, tile_workers=1, channels_last=False, \
+					frame_callback=None):
+	r"""Denoises the temporal windows of a sequence given by a table of frame indices.
+
+	Args:
+		seq: Tensor. [numframes, C, H, W] array containing the noisy input frames
+		noise_std: Tensor. Standard deviation of the added noise
+		idx_table: LongTensor, [numwins, temp_psz]. Indices in seq of the frames of
+			each window (see get_window_indices())
+		model_temporal, batch_size, tile_size, tile_overlap, tile_workers, channels_last,
+			frame_callback: see denoise_seq_fastdvdnet()
+	Returns:
+		denframes: Tensor, [numwins, C, H, W]
+	"""
 	# init arrays to handle contiguous frames and related patches
-	numframes, C, H, W = seq.shape
-	ctrlfr_idx = int((temp_psz-1)//2)
-	inframes = list()
-	denframes = torch.empty((numframes, C, H, W)).to(seq.device)
+	_, C, H, W = seq.shape
+	numwins, temp_psz = idx_table.shape
+	denframes = torch.empty((numwins, C, H, W)).to(seq.device)
 
+	# make size a multiple of four, padding the sequence and the noise map only once
+	padexp = get_exp_padding(seq.size())
+	Hp, Wp = H+padexp[3], W+padexp[1]
+	if seq.dtype == torch.uint8:
+		# uint8 frames are converted and padded window by window
+		seq_pad = seq
+	else:
+		seq_pad = F.pad(input=seq, pad=padexp, mode='reflect')
 	# build noise map from noise std---assuming Gaussian noise
-	noise_map = noise_std.expand((1, 1, H, W))
-
-	for fridx in range(numframes):
-		# load input frames
-		if not inframes:
-		# if list not yet created, fill it with temp_patchsz frames
-			for idx in range(temp_psz):
-				relidx = abs(idx-ctrlfr_idx) # handle border conditions, reflect
-				inframes.append(seq[relidx])
-		else:
-			del inframes[0]
-			relidx = min(fridx + ctrlfr_idx, -fridx + 2*(numframes-1)-ctrlfr_idx) # handle border conditions
-			inframes.append(seq[relidx])
+	noise_map = F.pad(input=noise_std.expand((1, 1, H, W)), pad=padexp, mode='reflect')
+	if channels_last:
+		# the frames of each window are interleaved per pixel, hence gathered into a
+		# channels_last buffer allocated once for the sequence
+		inframes_buf = torch.empty((min(batch_size, numwins), temp_psz*C, Hp, Wp), \
+								   device=seq.device).contiguous(memory_format=torch.channels_last)
 
-		inframes_t = torch.stack(inframes, dim=0).contiguous().view((1, temp_psz*C, H, W)).to(seq.device)
+	for fridx in range(0, numwins, batch_size):
+		# load input frames of batch_size windows
+		win_idx = idx_table[fridx:fridx+batch_size]
+		num_wins = win_idx.size(0)
+		inframes_t = seq_pad[win_idx.view(-1)]
+		if seq_pad.dtype == torch.uint8:
+			inframes_t = F.pad(input=frames_to_float(inframes_t), pad=padexp, mode='reflect')
+		inframes_t = inframes_t.view((num_wins, temp_psz*C, Hp, Wp))
+		if channels_last:
+			inframes_t = inframes_buf[:num_wins].copy_(inframes_t)
 
-		# append result to output list
-		denframes[fridx] = temp_denoise(model_temporal, inframes_t, noise_map)
+		# denoise and append result to output
+		out = run_model(model_temporal, (inframes_t, noise_map.expand((num_wins, 1, Hp, Wp))), \
+						tile_size, tile_overlap, tile_workers)
+		denframes[fridx:fridx+num_wins] = crop_exp_padding(out, padexp).clamp_(0., 1.)
+		if frame_callback is not None:
+			frame_callback(fridx, denframes[fridx:fridx+num_wins])
 
 	# free memory up
-	del inframes
 	del inframes_t
+	del seq_pad
 	torch.cuda.empty_cache()
 
 	# convert to appropiate type and return
 	return denframes
+
+def get_cpu_groups(num_groups):
+	r"""Splits the CPUs available to this process into num_groups groups of
+	contiguous CPU ids. Contiguous ids usually belong to the same NUMA node.
+
+	Returns:
+		cpu_groups: list of num_groups lists of CPU ids
+	"""
+	cpus = sorted(os.sched_getaffinity(0))
+	if num_groups > len(cpus):
+		raise Exception('Cannot split {} CPUs into {} groups'.format(len(cpus), num_groups))
+	bounds = [len(cpus)*grp//num_groups for grp in range(num_groups+1)]
+	return [cpus[bounds[grp]:bounds[grp+1]] for grp in range(num_groups)]
+
+def get_shard_ranges(numframes, num_shards, batch_size=1):
+	r"""Splits the frames of a sequence into num_shards contiguous ranges. The
+	bounds are multiples of batch_size, so that the windows are batched as in a
+	serial run of denoise_seq_fastdvdnet().
+
+	Returns:
+		ranges: list of (start, stop) frame ranges, without empty ranges
+	"""
+	num_batches = (numframes + batch_size - 1) // batch_size
+	shard_len = batch_size * ((num_batches + num_shards - 1) // num_shards)
+	return [(start, min(start+shard_len, numframes)) \
+			for start in range(0, numframes, shard_len)]
+
+def init_shard_worker(model_temporal):
+	r"""Initializes a worker process of create_shard_pool(). The weights of the
+	model are shared with the main process
+	"""
+	global SHARD_WORKER_MODEL
+	SHARD_WORKER_MODEL = model_temporal
+
+def create_shard_pool(model_temporal, num_shards):
+	r"""Creates the pool of num_shards worker processes used by denoise_seq_sharded().
+	The pool can be reused for several sequences, so that the workers are started
+	and receive the model only once. It must be closed by the caller.
+	"""
+	model = unwrap_model(model_temporal)
+	model.share_memory()
+	ctx = mp.get_context('spawn')
+	return ctx.Pool(num_shards, initializer=init_shard_worker, initargs=(model,))
+
+def denoise_shard(seq, noise_std, idx_table, denoise_args, cpus, num_threads, bf16):
+	r"""Denoises a shard of a sequence in a worker process of denoise_seq_sharded()
+	"""
+	if cpus is not None:
+		# pin the worker to its group of CPUs
+		os.sched_setaffinity(0, cpus)
+	torch.set_num_threads(num_threads)
+	with torch.no_grad(), cpu_autocast(bf16), noise_level(SHARD_WORKER_MODEL, noise_std):
+		return denoise_windows(seq, noise_std, idx_table, SHARD_WORKER_MODEL, **denoise_args)
+
+def denoise_seq_sharded(seq, noise_std, temp_psz, model_temporal, num_shards, batch_size=1, \
+						tile_size=None, tile_overlap=16, tile_workers=1, channels_last=False, \
+						cpu_groups=None, bf16=False, pool=None):
+	r"""Denoises a sequence of frames with FastDVDnet on num_shards CPU worker processes.
+
+	The sequence is cut into contiguous ranges of frames, each one extended by a
+	halo of (temp_psz-1)/2 frames on both sides. The windows of each range are
+	built from the table of frame indices of the whole sequence, so that they
+	reflect at the true ends of the sequence only. The workers share the weights
+	of the model and the outputs are stitched in order. As the shard bounds are
+	multiples of batch_size, every batch of windows is the same as in
+	denoise_seq_fastdvdnet() with the same batch_size. The workers run with fewer
+	threads than a serial run, so the results may differ by floating-point rounding.
+	model_temporal must be a regular PyTorch module (TorchScript and ONNX Runtime
+	models can't be sent to the workers).
+
+	Args:
+		seq: Tensor. [numframes, C, H, W] array containing the noisy input frames (on CPU)
+		noise_std: Tensor. Standard deviation of the added noise
+		temp_psz: size of the temporal patch. If None, the one of the model is used
+		model_temporal: instance of the PyTorch model of the temporal denoiser
+		num_shards: number of worker processes
+		batch_size, tile_size, tile_overlap, tile_workers, channels_last: see
+			denoise_seq_fastdvdnet()
+		cpu_groups: if not None, list of num_shards lists of CPU ids (see
+			get_cpu_groups()). Each worker is pinned to one group and uses one thread
+			per CPU of its group. Otherwise, the threads are split evenly between
+			the workers
+		bf16: if True, the workers run the model under bfloat16 autocast
+		pool: if not None, pool of num_shards workers created by create_shard_pool()
+			with model_temporal. Otherwise, a pool is created for this sequence only
+	Returns:
+		denframes: Tensor, [numframes, C, H, W]
+	"""
+	if seq.is_cuda:
+		raise Exception('Sharded denoising runs on CPU only')
+	if temp_psz is None:
+		temp_psz = get_num_input_frames(model_temporal)
+
+	numframes = seq.size(0)
+	idx_table = get_window_indices(numframes, temp_psz)
+	ranges = get_shard_ranges(numframes, num_shards, batch_size)
+	if cpu_groups is None:
+		cpu_groups = [None] * len(ranges)
+		num_threads = [max(torch.get_num_threads() // num_shards, 1)] * len(ranges)
+	else:
+		num_threads = [len(cpus) for cpus in cpu_groups]
+	denoise_args = {'batch_size': batch_size, 'tile_size': tile_size, \
+					'tile_overlap': tile_overlap, 'tile_workers': tile_workers, \
+					'channels_last': channels_last}
+
+	shards = []
+	for shard, (start, stop) in enumerate(ranges):
+		# frames of the range and its halo, indexed relatively to the first one
+		shard_idx = idx_table[start:stop]
+		first, last = shard_idx.min().item(), shard_idx.max().item()
+		shards.append((seq[first:last+1].clone().share_memory_(), noise_std, \
+					   shard_idx - first, denoise_args, cpu_groups[shard], \
+					   num_threads[shard], bf16))
+
+	if pool is not None:
+		outs = pool.starmap(denoise_shard, shards, chunksize=1)
+	else:
+		with create_shard_pool(model_temporal, num_shards) as seq_pool:
+			outs = seq_pool.starmap(denoise_shard, shards, chunksize=1)
+
+	return torch.cat(outs, dim=0)
+
+def denoise_stream_fastdvdnet(frames, noise_std, temp_psz, model_temporal, device=None, \
+							  tile_size=None, tile_overlap=16, tile_workers=1, channels_last=False):
+	r"""Denoises a stream of frames of unknown length with FastDVDnet.
+
+	Only the frames of the current temporal window are kept in memory, so that the
+	memory usage does not depend on the length of the sequence. A denoised frame is
+	yielded as soon as the (temp_psz-1)/2 following frames are available, or once the
+	stream has ended. Border conditions are the same as in denoise_seq_fastdvdnet().
+
+	Args:
+		frames: iterable of Tensors (or numpy arrays) of dims [C, H, W] containing the
+			noisy input frames in the [0., 1.] range (or uint8 in [0, 255]). If noise_std
+			is None, iterable of (frame, noise_std) pairs with the standard deviation of
+			the noise of each frame
+		noise_std: Tensor. Standard deviation of the added noise, or None if it is
+			given with each frame. The noise map of a window is the one of its
+			central frame
+		temp_psz: size of the temporal patch. If None, the one of the model is used
+		model_temporal: instance of the PyTorch model of the temporal denoiser
+		device: if not None, device to which the input frames (and noise stds) are moved
+		tile_size, tile_overlap, tile_workers: if tile_size is not None, the model
+			runs on overlapping tiles (see tiled_apply())
+		channels_last: if True, the windows are built in the channels_last memory
+			format (see prepare_cpu_inference())
+	Yields:
+		denframe: Tensor, [C, H, W]
+	"""
+	if temp_psz is None:
+		temp_psz = get_num_input_frames(model_temporal)
+	ctrlfr_idx = int((temp_psz-1)//2)
+	inframes = OrderedDict() # ring buffer with the last temp_psz (padded) frames
+	noise_maps = OrderedDict() # and their padded noise maps if noise_std is None
+	frame_stds = OrderedDict() # and their noise stds
+	noise_map = None
+	numframes = 0
+
+	def denoise_frame(fridx, seq_len):
+		# reflect at the end of the sequence only once its length is known
+		win_idx = [abs(fridx+off) for off in range(-ctrlfr_idx, ctrlfr_idx+1)]
+		if seq_len is not None:
+			win_idx = [reflect_index(idx, seq_len) for idx in win_idx]
+		if channels_last:
+			# concatenated straight into a channels_last buffer allocated once
+			inframes_t = torch.cat([inframes[idx] for idx in win_idx], dim=1, out=inframes_buf)
+		else:
+			inframes_t = torch.cat([inframes[idx] for idx in win_idx], dim=1)
+		with noise_level(model_temporal, frame_stds.get(fridx, noise_std)):
+			out = run_model(model_temporal, (inframes_t, noise_maps.get(fridx, noise_map)), \
+							tile_size, tile_overlap, tile_workers)
+		return crop_exp_padding(out.clamp_(0., 1.), padexp)[0]
+
+	for inidx, frame in enumerate(frames):
+		if noise_std is None:
+			frame, frame_std = frame
+		if not torch.is_tensor(frame):
+			frame = torch.from_numpy(frame)
+		if device is not None:
+			frame = frame.to(device)
+		frame = frames_to_float(frame)
+		frame = frame.view((1,) + tuple(frame.shape[-3:]))
+
+		# build padded noise map from the size of the first frame
+		if inidx == 0:
+			_, C, H, W = frame.shape
+			padexp = get_exp_padding(frame.size())
+			if channels_last:
+				inframes_buf = torch.empty((1, temp_psz*C, H+padexp[3], W+padexp[1]), \
+										   device=frame.device).contiguous(memory_format=torch.channels_last)
+			if noise_std is not None:
+				noise_map = F.pad(input=noise_std.expand((1, 1, H, W)), pad=padexp, mode='reflect')
+		if noise_std is None:
+			frame_std = torch.as_tensor(frame_std, dtype=torch.float32, device=frame.device)
+			noise_maps[inidx] = F.pad(input=frame_std.expand((1, 1, H, W)), pad=padexp, mode='reflect')
+			frame_stds[inidx] = frame_std
+			if len(noise_maps) > temp_psz:
+				noise_maps.popitem(last=False)
+				frame_stds.popitem(last=False)
+
+		inframes[inidx] = F.pad(input=frame, pad=padexp, mode='reflect')
+		if len(inframes) > temp_psz:
+			inframes.popitem(last=False)
+		numframes = inidx + 1
+
+		if inidx >= ctrlfr_idx:
+			yield denoise_frame(inidx-ctrlfr_idx, None)
+
+	# flush the last frames, reflecting at the end of the sequence
+	if 0 < numframes <= ctrlfr_idx:
+		raise Exception('A stream of {} frames is too short for a temporal window of {} frames, '\
+						'at least {} frames are needed'.format(numframes, temp_psz, ctrlfr_idx+1))
+	for fridx in range(max(numframes-ctrlfr_idx, 0), numframes):
+		yield denoise_frame(fridx, numframes)
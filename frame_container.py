@@ -0,0 +1,205 @@
+"""
+Chunked container of uint8 frames.
+
+A container is a single file with a header, a sequence of chunks and an index:
+	header: magic, version, number of channels C, height H, width W, number of frames
+		per chunk and compression (0: none, 1: zlib)
+	chunks: the frames [C, H, W] of each chunk, compressed as a whole if enabled
+	index: (offset, size, number of frames) of each chunk, followed by a footer with
+		the offset of the index, the number of chunks and the number of frames
+Frames are appended with FrameContainerWriter (the index is written when closing it,
+and a closed container can be reopened to append more frames) and read in any order
+with FrameContainerReader. export_png() converts a container to PNG files.
+
+This program is free software: you can use, modify and/or
+redistribute it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either
+version 3 of the License, or (at your option) any later
+version. You should have received a copy of this license along
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import zlib
+import struct
+import argparse
+import numpy as np
+import cv2
+
+CONTAINEREXT = '.fdvc'
+MAGIC = b'FDVDFRMS'
+FOOTER_MAGIC = b'FDVDINDX'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIIIB') # magic, version, C, H, W, frames per chunk, compression
+INDEX_ENTRY = struct.Struct('<QQI') # offset, size, number of frames of a chunk
+FOOTER = struct.Struct('<QIQ8s') # offset of the index, number of chunks, number of frames, magic
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+
+def read_index(f):
+	r"""Reads the header and the index of the container opened as f.
+
+	Returns:
+		header: tuple (C, H, W, frames_per_chunk, compression)
+		index: list of (offset, size, number of frames) of the chunks
+		index_offset: offset of the index in the file
+	"""
+	f.seek(0)
+	magic, version, C, H, W, frames_per_chunk, compression = HEADER.unpack(f.read(HEADER.size))
+	if magic != MAGIC or version != VERSION:
+		raise Exception('{} is not a frame container (version {})'.format(f.name, VERSION))
+	f.seek(-FOOTER.size, os.SEEK_END)
+	index_offset, num_chunks, _, magic = FOOTER.unpack(f.read(FOOTER.size))
+	if magic != FOOTER_MAGIC:
+		raise Exception('{} has no index, it was not closed'.format(f.name))
+	f.seek(index_offset)
+	index = [INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size)) for _ in range(num_chunks)]
+	return (C, H, W, frames_per_chunk, compression), index, index_offset
+
+class FrameContainerWriter():
+	'''Append-only writer of a frame container.
+	Args:
+		path: (str)
+			Path of the container file
+		num_channels, height, width: (int)
+			Size of the frames. Ignored when appending to an existing container
+		frames_per_chunk: (int, optional, default=8)
+			Number of frames of each chunk
+		compress: (bool, optional, default=False)
+			If True, each chunk is compressed with zlib
+		level: (int, optional, default=1)
+			zlib compression level (1 is the fastest)
+		append: (bool, optional, default=False)
+			If True and path exists, frames are appended to the existing container
+	'''
+	def __init__(self, path, num_channels, height, width, frames_per_chunk=8, compress=False, \
+				 level=1, append=False):
+		self.level = level
+		self.pending = [] # frames of the chunk being filled
+		if append and os.path.isfile(path):
+			self.file = open(path, 'r+b')
+			header, self.index, index_offset = read_index(self.file)
+			self.shape = header[:3]
+			self.frames_per_chunk = header[3]
+			self.compression = header[4]
+			# the new chunks overwrite the index, which is written again on close
+			self.file.seek(index_offset)
+			self.file.truncate()
+		else:
+			self.file = open(path, 'wb')
+			self.index = []
+			self.shape = (num_channels, height, width)
+			self.frames_per_chunk = frames_per_chunk
+			self.compression = COMPRESS_ZLIB if compress else COMPRESS_NONE
+			self.file.write(HEADER.pack(MAGIC, VERSION, num_channels, height, width, \
+										frames_per_chunk, self.compression))
+
+	def write(self, frame):
+		'''Appends a uint8 frame of dims [C, H, W]
+		'''
+		frame = np.asarray(frame)
+		if frame.dtype != np.uint8 or frame.shape != self.shape:
+			raise Exception('Expected a uint8 frame of dims {}, got {} {}'.\
+							format(self.shape, frame.dtype, frame.shape))
+		self.pending.append(frame)
+		if len(self.pending) == self.frames_per_chunk:
+			self.flush_chunk()
+
+	def flush_chunk(self):
+		if not self.pending:
+			return
+		data = np.stack(self.pending).tobytes()
+		if self.compression == COMPRESS_ZLIB:
+			data = zlib.compress(data, self.level)
+		self.index.append((self.file.tell(), len(data), len(self.pending)))
+		self.file.write(data)
+		self.pending = []
+
+	def close(self):
+		'''Writes the last chunk and the index, and closes the file
+		'''
+		self.flush_chunk()
+		index_offset = self.file.tell()
+		for entry in self.index:
+			self.file.write(INDEX_ENTRY.pack(*entry))
+		num_frames = sum(entry[2] for entry in self.index)
+		self.file.write(FOOTER.pack(index_offset, len(self.index), num_frames, FOOTER_MAGIC))
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+class FrameContainerReader():
+	'''Random-access reader of a frame container. reader[idx] returns the uint8
+	frame idx of dims [C, H, W]. The last decoded chunk is kept in memory.
+	Args:
+		path: (str)
+			Path of the container file
+	'''
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		header, self.index, _ = read_index(self.file)
+		self.shape = header[:3]
+		self.compression = header[4]
+		# first frame of each chunk
+		self.starts = np.cumsum([0] + [entry[2] for entry in self.index])
+		self.cached = (None, None)
+
+	def read_chunk(self, chunk):
+		if self.cached[0] != chunk:
+			offset, size, num_frames = self.index[chunk]
+			self.file.seek(offset)
+			data = self.file.read(size)
+			if self.compression == COMPRESS_ZLIB:
+				data = zlib.decompress(data)
+			self.cached = (chunk, np.frombuffer(data, dtype=np.uint8).\
+								  reshape((num_frames,) + self.shape))
+		return self.cached[1]
+
+	def __getitem__(self, idx):
+		if idx < 0:
+			idx += len(self)
+		if idx < 0 or idx >= len(self):
+			raise IndexError('frame {} out of range'.format(idx))
+		chunk = int(np.searchsorted(self.starts, idx, side='right')) - 1
+		return self.read_chunk(chunk)[idx - self.starts[chunk]]
+
+	def __len__(self):
+		return int(self.starts[-1])
+
+	def close(self):
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+def export_png(path, out_dir, prefix=None):
+	r"""Exports the frames of the container path to out_dir as prefix_<idx>.png files.
+	prefix defaults to the name of the container.
+	"""
+	if prefix is None:
+		prefix = os.path.splitext(os.path.basename(path))[0]
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	with FrameContainerReader(path) as reader:
+		for idx in range(len(reader)):
+			frame = reader[idx].transpose(1, 2, 0)
+			if frame.shape[2] == 3:
+				frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+			cv2.imwrite(os.path.join(out_dir, '{}_{}.png'.format(prefix, idx)), frame)
+		return len(reader)
+
+if __name__ == "__main__":
+	# Parse arguments
+	parser = argparse.ArgumentParser(description="Export the frames of a container to PNG")
+	parser.add_argument("container", type=str, help='path of the container')
+	parser.add_argument("--out_dir", type=str, default='.', help='where to save the PNG files')
+	argspar = parser.parse_args()
+
+	num_frames = export_png(argspar.container, argspar.out_dir)
+	print('Exported {} frames to {}'.format(num_frames, argspar.out_dir))
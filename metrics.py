@@ -0,0 +1,118 @@
+"""
+Batched image quality metrics computed with PyTorch on the device of the images.
+
+psnr_per_frame() gives the same values as skimage's compare_psnr (used by
+utils.batch_psnr) and ssim_per_frame() the same values as skimage's compare_ssim
+with its default parameters (7x7 uniform window, sample covariance), up to the
+floating point summation order. StreamingMetrics accumulates them as frames are
+denoised.
+
+This program is free software: you can use, modify and/or
+redistribute it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either
+version 3 of the License, or (at your option) any later
+version. You should have received a copy of this license along
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import torch
+import torch.nn.functional as F
+
+SSIM_WIN_SIZE = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+def psnr_per_frame(img, imclean, data_range=1.):
+	r"""Computes the PSNR of each frame of a batch.
+
+	As in skimage, the difference is computed in float32 and the mean squared
+	error is accumulated in float64.
+
+	Args:
+		img: Tensor [N, C, H, W] containing the restored frames
+		imclean: Tensor [N, C, H, W] containing the reference frames
+		data_range: distance between the minimum and maximum possible values
+	Returns:
+		psnr: float64 Tensor [N]
+	"""
+	diff = img.float() - imclean.float().to(img.device)
+	mse = (diff*diff).flatten(1).double().mean(dim=1)
+	return 10. * torch.log10(data_range**2 / mse)
+
+def ssim_per_frame(img, imclean, data_range=1.):
+	r"""Computes the SSIM of each frame of a batch, averaged over its channels.
+
+	As in skimage, the local statistics are computed in float64 on 7x7 uniform
+	windows with the sample covariance, and the windows crossing the borders of
+	the frames are discarded.
+
+	Args:
+		img: Tensor [N, C, H, W] containing the restored frames
+		imclean: Tensor [N, C, H, W] containing the reference frames
+		data_range: distance between the minimum and maximum possible values
+	Returns:
+		ssim: float64 Tensor [N]
+	"""
+	N, C, H, W = img.shape
+	x = img.double().reshape(N*C, 1, H, W)
+	y = imclean.double().to(img.device).reshape(N*C, 1, H, W)
+	num_px = SSIM_WIN_SIZE**2
+	cov_norm = num_px / (num_px - 1.)
+
+	# local means, variances and covariance of all the windows in a single pooling
+	stats = F.avg_pool2d(torch.cat((x, y, x*x, y*y, x*y), dim=1), SSIM_WIN_SIZE, stride=1)
+	ux, uy, uxx, uyy, uxy = stats.unbind(1)
+	vx = cov_norm * (uxx - ux*ux)
+	vy = cov_norm * (uyy - uy*uy)
+	vxy = cov_norm * (uxy - ux*uy)
+
+	C1 = (SSIM_K1 * data_range)**2
+	C2 = (SSIM_K2 * data_range)**2
+	ssim_map = ((2*ux*uy + C1) * (2*vxy + C2)) / ((ux*ux + uy*uy + C1) * (vx + vy + C2))
+	return ssim_map.view(N, -1).mean(dim=1)
+
+def batch_psnr(img, imclean, data_range):
+	r"""Computes the PSNR averaged along the batch dimension, like utils.batch_psnr
+	"""
+	return psnr_per_frame(img, imclean, data_range).mean().item()
+
+class StreamingMetrics():
+	'''Accumulates the per-frame PSNR (and SSIM) of frames as they are denoised.
+	Args:
+		data_range: (float, optional, default=1.)
+			Distance between the minimum and maximum possible values
+		ssim: (bool, optional, default=False)
+			If True, also compute the SSIM
+		psnr: (bool, optional, default=True)
+			If False, don't compute the PSNR
+	'''
+	def __init__(self, data_range=1., ssim=False, psnr=True):
+		self.data_range = data_range
+		self.compute_ssim = ssim
+		self.compute_psnr = psnr
+		self.psnr_sum = 0.
+		self.ssim_sum = 0.
+		self.num_frames = 0
+
+	def update(self, img, imclean):
+		'''Adds the frames img [N, C, H, W] with references imclean [N, C, H, W]
+		'''
+		if self.compute_psnr:
+			self.psnr_sum += psnr_per_frame(img, imclean, self.data_range).sum().item()
+		if self.compute_ssim:
+			self.ssim_sum += ssim_per_frame(img, imclean, self.data_range).sum().item()
+		self.num_frames += img.size(0)
+
+	def enabled(self):
+		'''Returns True if any metric is computed
+		'''
+		return self.compute_psnr or self.compute_ssim
+
+	def psnr(self):
+		'''Returns the average PSNR of the frames added so far (None if not computed)
+		'''
+		return self.psnr_sum / self.num_frames if self.compute_psnr else None
+
+	def ssim(self):
+		'''Returns the average SSIM of the frames added so far (None if not computed)
+		'''
+		return self.ssim_sum / self.num_frames if self.compute_ssim else None
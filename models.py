@@ -10,8 +10,33 @@ version 3 of the License, or (at your option) any later
 version. You should have received a copy of this license along
 this program. If not, see <http://www.gnu.org/licenses/>.
 """
+import copy
+import threading
+import contextlib
+from collections import OrderedDict
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+# guards the noise caches of InputCvBlock, which are shared by the tile worker threads.
+# Module-level so that the models can still be pickled and deep-copied
+NOISE_CACHE_LOCK = threading.Lock()
+
+class ChunkedBatchNorm2d(nn.BatchNorm2d):
+	'''BatchNorm2d whose batch statistics are computed separately on num_chunks
+	equal chunks of the input in training mode. Applying it to the concatenation of
+	num_chunks batches is equivalent to applying a BatchNorm2d to each of them in
+	turn, running statistics included. In evaluation mode it is a BatchNorm2d.
+	'''
+	def __init__(self, num_features):
+		super(ChunkedBatchNorm2d, self).__init__(num_features)
+		self.num_chunks = 1
+
+	def forward(self, x):
+		if not self.training or self.num_chunks == 1:
+			return super(ChunkedBatchNorm2d, self).forward(x)
+		return torch.cat([super(ChunkedBatchNorm2d, self).forward(chunk) \
+						  for chunk in x.chunk(self.num_chunks, dim=0)], dim=0)
 
 class CvBlock(nn.Module):
 	'''(Conv2d => BN => ReLU) x 2'''
@@ -19,10 +44,10 @@ class CvBlock(nn.Module):
 		super(CvBlock, self).__init__()
 		self.convblock = nn.Sequential(
 			nn.Conv2d(in_ch, out_ch, kernel_size=3, padding=1, bias=False),
-			nn.BatchNorm2d(out_ch),
+			ChunkedBatchNorm2d(out_ch),
 			nn.ReLU(inplace=True),
 			nn.Conv2d(out_ch, out_ch, kernel_size=3, padding=1, bias=False),
-			nn.BatchNorm2d(out_ch),
+			ChunkedBatchNorm2d(out_ch),
 			nn.ReLU(inplace=True)
 		)
 
@@ -37,23 +62,89 @@ class InputCvBlock(nn.Module):
 		self.convblock = nn.Sequential(
 			nn.Conv2d(num_in_frames*(3+1), num_in_frames*self.interm_ch, \
 					  kernel_size=3, padding=1, groups=num_in_frames, bias=False),
-			nn.BatchNorm2d(num_in_frames*self.interm_ch),
+			ChunkedBatchNorm2d(num_in_frames*self.interm_ch),
 			nn.ReLU(inplace=True),
 			nn.Conv2d(num_in_frames*self.interm_ch, out_ch, kernel_size=3, padding=1, bias=False),
-			nn.BatchNorm2d(out_ch),
+			ChunkedBatchNorm2d(out_ch),
 			nn.ReLU(inplace=True)
 		)
+		# constant noise map folding (inference only), see forward_folded()
+		self.fold_noise_map = False
+		self.noise_sigma = None # noise level of the inputs if known, see noise_level()
+		self.noise_cache_size = 8
+		self.noise_cache = OrderedDict()
 
 	def forward(self, x):
 		return self.convblock(x)
 
+	def noise_contribution(self, noise_map, w_noise, sigma=None):
+		'''Returns the contribution of the (spatially constant) noise map of one
+		sample to the output of the first convolution. It is cached per noise level
+		and resolution. If sigma is None, the noise level is read from noise_map.
+		'''
+		conv = self.convblock[0]
+		if sigma is None:
+			sigma = noise_map[0, 0, 0, 0].item()
+		key = (sigma, noise_map.size(-2), noise_map.size(-1), noise_map.device, noise_map.dtype)
+		with NOISE_CACHE_LOCK:
+			contrib = self.noise_cache.get(key)
+			if contrib is not None:
+				self.noise_cache.move_to_end(key)
+				return contrib
+		# computed outside of the lock, concurrent misses on the same key are harmless
+		contrib = F.conv2d(noise_map, w_noise, stride=conv.stride, padding=conv.padding)
+		with NOISE_CACHE_LOCK:
+			self.noise_cache[key] = contrib
+			self.noise_cache.move_to_end(key)
+			while len(self.noise_cache) > self.noise_cache_size:
+				self.noise_cache.popitem(last=False)
+		return contrib
+
+	def forward_folded(self, frames, noise_map):
+		'''Equivalent to forward() on the concatenation of each frame in frames
+		with noise_map, for noise maps constant over H and W (as in inference).
+
+		The first convolution is linear, so the contribution of the noise map
+		channels only depends on the noise level and the resolution (it is constant
+		except at the borders, because of the zero padding). It is precomputed and
+		cached, and only the image channels are convolved.
+
+		The noise level is the one set with noise_level() if any. Otherwise it is read
+		back from noise_map, which needs a device to host copy at every call, and the
+		noise map is checked to be constant over H and W.
+		'''
+		conv = self.convblock[0]
+		num_in_frames = len(frames)
+		C = frames[0].size(1)
+		w = conv.weight.view((num_in_frames, -1, C+1) + tuple(conv.weight.shape[-2:]))
+		w_img = w[:, :, :C].reshape((-1, C) + tuple(conv.weight.shape[-2:]))
+		w_noise = w[:, :, C:].reshape((-1, 1) + tuple(conv.weight.shape[-2:]))
+
+		x = F.conv2d(torch.cat(frames, dim=1), w_img, bias=conv.bias, stride=conv.stride, \
+					 padding=conv.padding, groups=num_in_frames)
+		if self.noise_sigma is not None:
+			return self.convblock[1:](x + self.noise_contribution(noise_map[0:1], w_noise, \
+																   self.noise_sigma))
+
+		N = noise_map.size(0)
+		if not bool((noise_map == noise_map[:, :, :1, :1]).all()):
+			raise Exception('Noise map folding needs noise maps constant over H and W')
+		sigmas = noise_map[:, 0, 0, 0].tolist()
+		if sigmas.count(sigmas[0]) == N:
+			x = x + self.noise_contribution(noise_map[0:1], w_noise)
+		else:
+			x = x + torch.cat([self.noise_contribution(noise_map[n:n+1], w_noise) \
+							   for n in range(N)], dim=0)
+
+		return self.convblock[1:](x)
+
 class DownBlock(nn.Module):
 	'''Downscale + (Conv2d => BN => ReLU)*2'''
 	def __init__(self, in_ch, out_ch):
 		super(DownBlock, self).__init__()
 		self.convblock = nn.Sequential(
 			nn.Conv2d(in_ch, out_ch, kernel_size=3, padding=1, stride=2, bias=False),
-			nn.BatchNorm2d(out_ch),
+			ChunkedBatchNorm2d(out_ch),
 			nn.ReLU(inplace=True),
 			CvBlock(out_ch, out_ch)
 		)
@@ -80,7 +171,7 @@ class OutputCvBlock(nn.Module):
 		super(OutputCvBlock, self).__init__()
 		self.convblock = nn.Sequential(
 			nn.Conv2d(in_ch, in_ch, kernel_size=3, padding=1, bias=False),
-			nn.BatchNorm2d(in_ch),
+			ChunkedBatchNorm2d(in_ch),
 			nn.ReLU(inplace=True),
 			nn.Conv2d(in_ch, out_ch, kernel_size=3, padding=1, bias=False)
 		)
@@ -121,13 +212,24 @@ class DenBlock(nn.Module):
 		for _, m in enumerate(self.modules()):
 			self.weight_init(m)
 
+	def set_num_chunks(self, num_chunks):
+		'''Sets the number of independent batches the inputs of forward() are made of,
+		so that the BN layers compute the batch statistics of each of them separately
+		'''
+		for m in self.modules():
+			if isinstance(m, ChunkedBatchNorm2d):
+				m.num_chunks = num_chunks
+
 	def forward(self, in0, in1, in2, noise_map):
 		'''Args:
 			inX: Tensor, [N, C, H, W] in the [0., 1.] range
 			noise_map: Tensor [N, 1, H, W] in the [0., 1.] range
 		'''
 		# Input convolution block
-		x0 = self.inc(torch.cat((in0, noise_map, in1, noise_map, in2, noise_map), dim=1))
+		if self.inc.fold_noise_map and not self.training:
+			x0 = self.inc.forward_folded((in0, in1, in2), noise_map)
+		else:
+			x0 = self.inc(torch.cat((in0, noise_map, in1, noise_map, in2, noise_map), dim=1))
 		# Downsampling
 		x1 = self.downc0(x0)
 		x2 = self.downc1(x1)
@@ -144,6 +246,11 @@ class DenBlock(nn.Module):
 
 class FastDVDnet(nn.Module):
 	""" Definition of the FastDVDnet model.
+	The num_input_frames (odd) input frames are denoised by a tree of 3-frame
+	DenBlocks: stage k (block tempk) denoises num_input_frames-2*k overlapping
+	triplets of the outputs of stage k-1. Each intermediate result is computed once
+	and shared by the triplets of the next stage. With the default of 5 frames this
+	is the original two-stage model.
 	Inputs of forward():
 		xn: input frames of dim [N, C, H, W], (C=3 RGB)
 		noise_map: array with noise map of dim [N, 1, H, W]
@@ -151,10 +258,17 @@ class FastDVDnet(nn.Module):
 
 	def __init__(self, num_input_frames=5):
 		super(FastDVDnet, self).__init__()
+		if num_input_frames < 3 or num_input_frames%2 == 0:
+			raise Exception('The number of input frames must be odd and >= 3, got {}'.\
+							format(num_input_frames))
 		self.num_input_frames = num_input_frames
-		# Define models of each denoising stage
-		self.temp1 = DenBlock(num_input_frames=3)
-		self.temp2 = DenBlock(num_input_frames=3)
+		self.num_stages = (num_input_frames-1)//2
+		# Define models of each denoising stage (temp1, temp2, ...). The triplets of a
+		# stage are processed in a single batch
+		for stage in range(1, self.num_stages+1):
+			block = DenBlock(num_input_frames=3)
+			block.set_num_chunks(num_input_frames-2*stage)
+			setattr(self, 'temp{}'.format(stage), block)
 		# Init weights
 		self.reset_params()
 
@@ -167,20 +281,141 @@ class FastDVDnet(nn.Module):
 		for _, m in enumerate(self.modules()):
 			self.weight_init(m)
 
+	def stage_block(self, stage):
+		'''Returns the DenBlock of the given denoising stage (starting at 1)
+		'''
+		return getattr(self, 'temp{}'.format(stage))
+
+	def forward_stage(self, stage, xn, noise_map):
+		'''Denoises all the overlapping triplets of the list of tensors xn with the
+		block of the given stage. The triplets are concatenated along the batch dimension.
+		Returns the list of len(xn)-2 results.
+		'''
+		num_triplets = len(xn)-2
+		block = self.stage_block(stage)
+		if num_triplets == 1:
+			return [block(xn[0], xn[1], xn[2], noise_map)]
+		x = block(torch.cat(xn[0:num_triplets], dim=0), \
+				  torch.cat(xn[1:num_triplets+1], dim=0), \
+				  torch.cat(xn[2:num_triplets+2], dim=0), \
+				  torch.cat([noise_map]*num_triplets, dim=0))
+		x = torch.split(x, xn[0].size(0), dim=0)
+		return [x[m] for m in range(num_triplets)]
+
 	def forward(self, x, noise_map):
 		'''Args:
 			x: Tensor, [N, num_frames*C, H, W] in the [0., 1.] range
 			noise_map: Tensor [N, 1, H, W] in the [0., 1.] range
 		'''
 		# Unpack inputs
-		(x0, x1, x2, x3, x4) = tuple(x[:, 3*m:3*m+3, :, :] for m in range(self.num_input_frames))
+		xn = [x[:, 3*m:3*m+3, :, :] for m in range(self.num_input_frames)]
 
-		# First stage
-		x20 = self.temp1(x0, x1, x2, noise_map)
-		x21 = self.temp1(x1, x2, x3, noise_map)
-		x22 = self.temp1(x2, x3, x4, noise_map)
+		# Denoising stages
+		for stage in range(1, self.num_stages+1):
+			xn = self.forward_stage(stage, xn, noise_map)
 
-		#Second stage
-		x = self.temp2(x20, x21, x22, noise_map)
+		return xn[0]
 
-		return x
+def num_input_frames_from_state_dict(state_dict):
+	'''Returns the number of input frames of the FastDVDnet model whose state
+	dictionary (without the DataParallel wrapper) is state_dict
+	'''
+	stages = set(k.split('.')[0] for k in state_dict.keys() if k.startswith('temp'))
+	return 2*len(stages)+1
+
+def fuse_conv_bn(conv, bn):
+	r"""Returns a Conv2d layer with bias equivalent to conv followed by bn in
+	evaluation mode (i.e. using the running statistics of bn).
+	"""
+	with torch.no_grad():
+		scale = bn.running_var.add(bn.eps).rsqrt()
+		if bn.affine:
+			scale = scale * bn.weight
+		shift = -bn.running_mean * scale
+		if bn.affine:
+			shift = shift + bn.bias
+		if conv.bias is not None:
+			shift = shift + conv.bias * scale
+
+		fused = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=conv.kernel_size, \
+						  stride=conv.stride, padding=conv.padding, dilation=conv.dilation, \
+						  groups=conv.groups, bias=True)
+		fused.weight = nn.Parameter(conv.weight * scale.view(-1, 1, 1, 1))
+		fused.bias = nn.Parameter(shift)
+	return fused
+
+def fold_batchnorm(model):
+	r"""Folds every BatchNorm2d layer of a trained model into the Conv2d layer
+	preceding it.
+
+	In evaluation mode a BN layer is a per-channel affine transform that can be
+	merged into the weights and bias of the previous convolution. The returned model
+	has no BN layers and is numerically equivalent (up to float rounding) to the
+	input model in evaluation mode. It is meant for inference only.
+
+	Args:
+		model: a FastDVDnet instance (possibly wrapped by nn.DataParallel) or any
+			model whose BN layers follow a Conv2d layer in a nn.Sequential
+	Returns:
+		a folded copy of model, in evaluation mode
+	"""
+	if isinstance(model, nn.DataParallel):
+		model = model.module
+	model = copy.deepcopy(model).eval()
+
+	for seq in [m for m in model.modules() if isinstance(m, nn.Sequential)]:
+		layers = []
+		for layer in seq.children():
+			if isinstance(layer, nn.BatchNorm2d) and layers and isinstance(layers[-1], nn.Conv2d):
+				layers[-1] = fuse_conv_bn(layers[-1], layer)
+			else:
+				layers.append(layer)
+		for name in list(seq._modules.keys()):
+			del seq._modules[name]
+		for idx, layer in enumerate(layers):
+			seq.add_module(str(idx), layer)
+
+	return model
+
+def fold_noise_map(model, enable=True):
+	r"""Enables (or disables) the folding of the noise map channels in the input
+	blocks of every DenBlock of model, see InputCvBlock.forward_folded().
+
+	The contribution of the noise map to the first convolution is precomputed once
+	per noise level and resolution, and the concatenation of the noise map with the
+	frames is skipped. This is only valid in evaluation mode, for noise maps which
+	are constant over H and W, and it must be enabled after loading the weights.
+
+	Args:
+		model: a FastDVDnet instance, possibly wrapped by nn.DataParallel
+		enable: bool
+	"""
+	for m in model.modules():
+		if isinstance(m, InputCvBlock):
+			m.fold_noise_map = enable
+			with NOISE_CACHE_LOCK:
+				m.noise_cache.clear()
+	return model
+
+@contextlib.contextmanager
+def noise_level(model, noise_std):
+	r"""Context in which the folded input blocks of model (see fold_noise_map()) take
+	noise_std as the noise level of all their inputs, instead of reading it back from
+	the noise maps at every forward. The noise maps passed to the model in the
+	context must be constant, equal to noise_std.
+
+	Args:
+		model: any model. Only the InputCvBlock modules with folding enabled are affected
+		noise_std: float or one-element Tensor, read once when entering the context
+	"""
+	blocks = [m for m in model.modules() if isinstance(m, InputCvBlock) and m.fold_noise_map] \
+			 if isinstance(model, nn.Module) else []
+	if blocks:
+		sigma = float(noise_std)
+		for m in blocks:
+			m.noise_sigma = sigma
+	try:
+		yield
+	finally:
+		for m in blocks:
+			m.noise_sigma = None
@@ -0,0 +1,77 @@
+"""
+Noise models used to synthesize noisy training and test data.
+
+All the noises are generated with batched PyTorch operations on the device of the
+clean images, and can be made reproducible by passing a torch.Generator.
+
+This program is free software: you can use, modify and/or
+redistribute it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either
+version 3 of the License, or (at your option) any later
+version. You should have received a copy of this license along
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import math
+import torch
+
+NOISE_TYPES = ('gaussian', 'uniform', 'poisson', 's&p', 'speckle')
+
+def get_generator(seed, device):
+	'''Returns a torch.Generator on device seeded with seed, or None if seed is None
+	'''
+	if seed is None:
+		return None
+	gen = torch.Generator(device=device)
+	gen.manual_seed(seed)
+	return gen
+
+def add_noise(img, type_noise='gaussian', noise_ival=(5/255., 55/255.), poisson_peak=25., \
+			  sp_amount=0.05, salt_vs_pepper=0.5, speckle_var=0.05, generator=None):
+	r"""Adds noise to a batch of images.
+
+	Args:
+		img: Tensor [N, ...] of clean images in the range [0., 1.]
+		type_noise: one of NOISE_TYPES
+			"gaussian": AWGN of std drawn uniformly in noise_ival for each sample
+			"uniform": uniform noise of std drawn uniformly in noise_ival for each sample
+			"poisson": Poisson noise of peak value poisson_peak
+			"s&p": a proportion sp_amount of the values is replaced by 1. (salt) or
+				0. (pepper), salt_vs_pepper being the proportion of salt
+			"speckle": multiplicative Gaussian noise of variance speckle_var, clipped
+				to [0., 1.]
+		generator: if not None, torch.Generator (on the device of img) of the noise
+	Returns:
+		imgn: Tensor of the same shape as img with the noisy images
+		stdn: Tensor [N, 1, ..., 1] with the std of the noise of each sample: the
+			std drawn for "gaussian" and "uniform", the std of the difference
+			between imgn and img otherwise
+	"""
+	if type_noise not in NOISE_TYPES:
+		raise Exception('Unknown noise type {}, expected one of {}'.format(type_noise, NOISE_TYPES))
+	sh_std = (img.size(0),) + (1,)*(img.dim()-1)
+
+	if type_noise in ('gaussian', 'uniform'):
+		# std dev of each sample
+		stdn = torch.empty(sh_std, device=img.device).uniform_(noise_ival[0], noise_ival[1], \
+															   generator=generator)
+		if type_noise == 'gaussian':
+			noise = torch.randn(img.shape, device=img.device, generator=generator)
+		else:
+			# uniform in [-sqrt(3), sqrt(3)] has unit variance
+			noise = torch.rand(img.shape, device=img.device, generator=generator)
+			noise = noise.mul_(2.).sub_(1.).mul_(math.sqrt(3.))
+		return torch.addcmul(img, noise, stdn), stdn
+
+	if type_noise == 'poisson':
+		imgn = torch.poisson(img.clamp(min=0.) * poisson_peak, generator=generator) / poisson_peak
+	elif type_noise == 's&p':
+		draw = torch.rand(img.shape, device=img.device, generator=generator)
+		imgn = torch.where(draw < sp_amount*salt_vs_pepper, torch.ones_like(img), \
+						   torch.where(draw < sp_amount, torch.zeros_like(img), img))
+	else:
+		noise = torch.randn(img.shape, device=img.device, generator=generator)
+		imgn = torch.addcmul(img, img, noise, value=math.sqrt(speckle_var)).clamp_(0., 1.)
+
+	# std dev of the noise of each sample, in one reduction
+	stdn = (imgn - img).flatten(1).std(dim=1).view(sh_std)
+	return imgn, stdn
@@ -0,0 +1,136 @@
+"""
+ONNX export of FastDVDnet and ONNX Runtime inference backend.
+
+The exported graph has dynamic batch size, height and width. OnnxRuntimeModel
+wraps an ONNX Runtime session with the same call signature as FastDVDnet, so it
+can be passed as model_temporal to the functions of fastdvdnet.py instead of the
+PyTorch model.
+
+This program is free software: you can use, modify and/or
+redistribute it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either
+version 3 of the License, or (at your option) any later
+version. You should have received a copy of this license along
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import torch
+from models import FastDVDnet, fold_batchnorm, fold_noise_map, num_input_frames_from_state_dict
+from fastdvdnet import get_num_input_frames
+from utils import load_checkpoint_state_dict
+
+ONNX_OPSET = 13
+ONNX_INPUTS = ['frames', 'noise_map']
+ONNX_OUTPUTS = ['denoised']
+
+def export_onnx(model, onnx_file, num_channels=3, opset=ONNX_OPSET):
+	r"""Exports a FastDVDnet model to ONNX with dynamic batch size, height and width.
+
+	The BN layers are folded into the convolutions before exporting.
+
+	Args:
+		model: FastDVDnet instance (possibly wrapped by nn.DataParallel) with its
+			trained weights loaded
+		onnx_file: path of the output .onnx file
+		num_channels: number of color channels of the frames
+		opset: ONNX opset version
+	"""
+	temp_psz = get_num_input_frames(model)
+	model = fold_noise_map(fold_batchnorm(model).cpu(), enable=False)
+	example_inputs = (torch.rand((1, temp_psz*num_channels, 64, 64)), \
+					  torch.rand((1, 1, 64, 64)))
+	dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} \
+					for name in ONNX_INPUTS + ONNX_OUTPUTS}
+	with torch.no_grad():
+		torch.onnx.export(model, example_inputs, onnx_file, input_names=ONNX_INPUTS, \
+						  output_names=ONNX_OUTPUTS, dynamic_axes=dynamic_axes, \
+						  opset_version=opset)
+
+class OnnxRuntimeModel():
+	'''Runs an exported FastDVDnet ONNX graph with ONNX Runtime.
+	Instances are called like FastDVDnet: model(x, noise_map) with x of dims
+	[N, num_frames*C, H, W] and noise_map of dims [N, 1, H, W], and return a
+	Tensor [N, C, H, W] on the device of x.
+	Args:
+		onnx_file: (str)
+			Path to the .onnx file written by export_onnx()
+		num_threads: (int, optional, default=0)
+			Number of intra-op threads of the session (0: ONNX Runtime default)
+		providers: (list of str, optional, default=None)
+			Execution providers of the session (default: CPU)
+		num_channels: (int, optional, default=3)
+			Number of color channels of the frames
+	'''
+	def __init__(self, onnx_file, num_threads=0, providers=None, num_channels=3):
+		import onnxruntime as ort
+
+		options = ort.SessionOptions()
+		options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+		if num_threads > 0:
+			options.intra_op_num_threads = num_threads
+		if providers is None:
+			providers = ['CPUExecutionProvider']
+		self.session = ort.InferenceSession(onnx_file, sess_options=options, providers=providers)
+		self.num_input_frames = self.session.get_inputs()[0].shape[1] // num_channels
+
+	def eval(self):
+		return self
+
+	def __call__(self, x, noise_map):
+		inputs = {ONNX_INPUTS[0]: x.detach().cpu().contiguous().numpy(), \
+				  ONNX_INPUTS[1]: noise_map.detach().cpu().contiguous().numpy()}
+		out = self.session.run(ONNX_OUTPUTS, inputs)[0]
+		return torch.from_numpy(out).to(x.device)
+
+def check_parity(model, onnx_model, height=128, width=128, batch_size=2, seed=0):
+	r"""Compares the outputs of a PyTorch model and its ONNX Runtime counterpart on
+	random inputs.
+
+	Returns:
+		max_abs_diff: float, maximum absolute difference between the outputs
+	"""
+	gen = torch.Generator().manual_seed(seed)
+	temp_psz = get_num_input_frames(model)
+	x = torch.rand((batch_size, temp_psz*3, height, width), generator=gen)
+	noise_map = torch.full((batch_size, 1, height, width), 25./255.)
+	with torch.no_grad():
+		out_torch = model.cpu().eval()(x, noise_map)
+	out_onnx = onnx_model(x, noise_map)
+	return (out_torch - out_onnx).abs().max().item()
+
+def main(**args):
+	r"""Exports a trained model to ONNX and checks the parity of ONNX Runtime
+	against PyTorch
+	"""
+	state_dict = load_checkpoint_state_dict(args['model_file'], map_location='cpu')
+	model = FastDVDnet(num_input_frames=num_input_frames_from_state_dict(state_dict))
+	model.load_state_dict(state_dict)
+	model.eval()
+
+	export_onnx(model, args['onnx_file'], opset=args['opset'])
+	print('Exported model to {}'.format(args['onnx_file']))
+
+	if not args['no_parity_check']:
+		onnx_model = OnnxRuntimeModel(args['onnx_file'])
+		for (height, width) in ((96, 128), (132, 180)):
+			max_diff = check_parity(model, onnx_model, height, width)
+			print('\tParity check {}x{}: max abs difference {:.2e}'.format(height, width, max_diff))
+			if max_diff > args['parity_tol']:
+				raise Exception('ONNX Runtime output differs from PyTorch by {:.2e} > {:.2e}'.\
+								format(max_diff, args['parity_tol']))
+
+if __name__ == "__main__":
+	# Parse arguments
+	parser = argparse.ArgumentParser(description="Export FastDVDnet to ONNX")
+	parser.add_argument("--model_file", type=str, default="./model.pth", \
+						help='path to model of the pretrained denoiser')
+	parser.add_argument("--onnx_file", type=str, default="./model.onnx", \
+						help='path of the exported ONNX model')
+	parser.add_argument("--opset", type=int, default=ONNX_OPSET, help='ONNX opset version')
+	parser.add_argument("--no_parity_check", action='store_true', \
+						help="don't compare ONNX Runtime outputs to PyTorch ones")
+	parser.add_argument("--parity_tol", type=float, default=1e-4, \
+						help='max abs difference allowed by the parity check')
+	argspar = parser.parse_args()
+
+	main(**vars(argspar))
@@ -0,0 +1,213 @@
+"""
+Pre-extracted store of training patches.
+
+The extraction tool draws random spatio-temporal patches from the training sequences
+(with the same sampling as dataloaders.train_cpu_loader) and writes them as uint8
+fixed-size records [F, C, H, W] to sharded binary files, described by an index.json
+file. train_patch_loader reads the records through memory maps, shuffling them at each
+epoch with a seeded permutation, so that runs are reproducible and can be resumed at
+any sample offset.
+
+This program is free software: you can use, modify and/or
+redistribute it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either
+version 3 of the License, or (at your option) any later
+version. You should have received a copy of this license along
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import argparse
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, RandomSampler
+from dataloaders import TrainSequenceDataset
+
+INDEXFILE = 'index.json'
+SHARDPATT = 'patches_{:05d}.bin'
+
+def extract_patches(file_root, out_dir, num_patches, sequence_length=5, crop_size=96, \
+					temp_stride=3, shard_size=16384, num_workers=4, seed=0):
+	r"""Extracts num_patches random patches of the sequences under file_root to out_dir.
+
+	Args:
+		file_root: path to directory with video sequences or image sequences (see
+			dataloaders.TrainSequenceDataset)
+		out_dir: output directory of the shards and the index
+		num_patches: number of patches to extract
+		sequence_length: number of frames of each patch
+		crop_size: spatial size of the patches
+		temp_stride: frame interval between the sequences the patches are drawn from
+		shard_size: number of patches per shard file
+		num_workers: number of decoding processes
+		seed: seed of the sampling of the patches
+	Returns:
+		index: dict written to out_dir/index.json
+	"""
+	torch.manual_seed(seed)
+	dataset = TrainSequenceDataset(file_root, sequence_length, crop_size, temp_stride)
+	sampler = RandomSampler(dataset, replacement=True, num_samples=num_patches)
+	loader = DataLoader(dataset, batch_size=256, sampler=sampler, num_workers=num_workers)
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+
+	shards = []
+	out_file = None
+	num_written = 0
+	for batch in loader:
+		batch = batch.numpy()
+		pos = 0
+		while pos < len(batch):
+			# open a new shard when the current one is full
+			if num_written % shard_size == 0:
+				if out_file is not None:
+					out_file.close()
+				shards.append(SHARDPATT.format(len(shards)))
+				out_file = open(os.path.join(out_dir, shards[-1]), 'wb')
+			num_rec = min(len(batch) - pos, shard_size - num_written % shard_size)
+			out_file.write(batch[pos:pos+num_rec].tobytes())
+			pos += num_rec
+			num_written += num_rec
+		print('\t{}/{} patches'.format(num_written, num_patches), end='\r')
+	if out_file is not None:
+		out_file.close()
+
+	# the index is written last, once all the shards are complete
+	index = {'num_patches': num_written, \
+			 'record_shape': [sequence_length, 3, crop_size, crop_size], \
+			 'dtype': 'uint8', \
+			 'shard_size': shard_size, \
+			 'shards': shards, \
+			 'file_root': os.path.abspath(file_root), \
+			 'temp_stride': temp_stride, \
+			 'seed': seed}
+	with open(os.path.join(out_dir, INDEXFILE), 'w') as f:
+		json.dump(index, f, indent=1)
+	return index
+
+class train_patch_loader():
+	'''Dataloader of a patch store written by extract_patches(), with the same
+	interface as dataloaders.train_dali_loader.
+	Iterating over it yields [{'data': batch}], with batch a float Tensor of shape
+	[N, F, C, H, W] in the range [0., 255.]. The order of the patches of each epoch
+	is a permutation seeded by seed and the epoch number.
+	Args:
+		batch_size: (int)
+			Size of the batches
+		patch_dir: (str)
+			Path to the directory of the patch store
+		epoch_size: (int, optional, default=-1)
+			Size of the epoch. If epoch_size <= 0, epoch_size will default to the number of patches
+		seed: (int, optional, default=0)
+			Seed of the shuffling
+		start_epoch: (int, optional, default=0)
+			Epoch of the first iteration over the loader
+		start_offset: (int, optional, default=0)
+			Sample offset in the first epoch, to resume an interrupted epoch
+		sequence_length: (int, optional, default=None)
+			Expected number of frames of the patches, checked against the store if not None
+		crop_size: (int, optional, default=None)
+			Expected spatial size of the patches, checked against the store if not None
+	'''
+	def __init__(self, batch_size, patch_dir, epoch_size=-1, seed=0, start_epoch=0, start_offset=0, \
+				 sequence_length=None, crop_size=None):
+		with open(os.path.join(patch_dir, INDEXFILE), 'r') as f:
+			self.index = json.load(f)
+		num_fr, _, height, width = self.index['record_shape']
+		if sequence_length is not None and num_fr != sequence_length:
+			raise Exception('The patches of {} have {} frames, expected {} (temp_patch_size)'.\
+							format(patch_dir, num_fr, sequence_length))
+		if crop_size is not None and (height, width) != (crop_size, crop_size):
+			raise Exception('The patches of {} are {}x{}, expected {}x{} (patch_size)'.\
+							format(patch_dir, height, width, crop_size, crop_size))
+		self.batch_size = batch_size
+		self.seed = seed
+		self.epoch = start_epoch
+		self.offset = start_offset
+		self.num_patches = self.index['num_patches']
+		self.shard_size = self.index['shard_size']
+
+		# memory map every shard as an array of records
+		record_shape = tuple(self.index['record_shape'])
+		record_len = int(np.prod(record_shape))
+		self.shards = []
+		for name in self.index['shards']:
+			fpath = os.path.join(patch_dir, name)
+			num_rec = os.path.getsize(fpath) // record_len
+			self.shards.append(np.memmap(fpath, dtype=self.index['dtype'], mode='r', \
+										 shape=(num_rec,) + record_shape))
+
+		# Define size of epoch
+		if epoch_size <= 0:
+			self.epoch_size = self.num_patches
+		else:
+			self.epoch_size = epoch_size
+
+	def set_epoch(self, epoch, offset=0):
+		'''Sets the epoch and the sample offset of the next iteration over the loader
+		'''
+		self.epoch = epoch
+		self.offset = offset
+
+	def get_order(self, epoch):
+		'''Returns the indices of the patches of the given epoch
+		'''
+		gen = torch.Generator().manual_seed(self.seed * 100003 + epoch)
+		num_perms = (self.epoch_size + self.num_patches - 1) // self.num_patches
+		return torch.cat([torch.randperm(self.num_patches, generator=gen) \
+						  for _ in range(num_perms)])[:self.epoch_size]
+
+	def read_batch(self, indices):
+		# read the records shard by shard, in increasing order within each shard
+		batch = torch.empty((len(indices),) + self.shards[0].shape[1:], dtype=torch.uint8)
+		shard_idx = indices // self.shard_size
+		for shard in shard_idx.unique().tolist():
+			pos = (shard_idx == shard).nonzero().view(-1)
+			rec = indices[pos] - shard*self.shard_size
+			rec, order = rec.sort()
+			batch[pos[order]] = torch.from_numpy(self.shards[shard][rec.numpy()])
+		return batch
+
+	def __len__(self):
+		return self.epoch_size
+
+	def __iter__(self):
+		order = self.get_order(self.epoch)
+		offset = self.offset
+		self.epoch += 1
+		self.offset = 0
+		for start in range(offset, self.epoch_size, self.batch_size):
+			yield [{'data': self.read_batch(order[start:start+self.batch_size]).float()}]
+
+def main(**args):
+	r"""Extracts a patch store from the training sequences
+	"""
+	index = extract_patches(args['trainset_dir'], args['out_dir'], args['num_patches'], \
+							sequence_length=args['temp_patch_size'], \
+							crop_size=args['patch_size'], \
+							temp_stride=args['temp_stride'], \
+							shard_size=args['shard_size'], \
+							num_workers=args['num_workers'], \
+							seed=args['seed'])
+	print('\nWrote {} patches in {} shards to {}'.format(index['num_patches'], \
+														 len(index['shards']), args['out_dir']))
+
+if __name__ == "__main__":
+	# Parse arguments
+	parser = argparse.ArgumentParser(description="Extract a store of training patches")
+	parser.add_argument("--trainset_dir", type=str, default=None, \
+						help='path of trainset (videos or image sequences)')
+	parser.add_argument("--out_dir", type=str, default="./patches", \
+						help='output directory of the patch store')
+	parser.add_argument("--num_patches", type=int, default=256000, help='number of patches')
+	parser.add_argument("--patch_size", "--p", type=int, default=96, help="Patch size")
+	parser.add_argument("--temp_patch_size", "--tp", type=int, default=5, \
+						help="Temporal patch size, i.e. number of frames of the patches")
+	parser.add_argument("--temp_stride", type=int, default=3, \
+						help='frame interval between the sequences the patches are drawn from')
+	parser.add_argument("--shard_size", type=int, default=16384, help='number of patches per shard')
+	parser.add_argument("--num_workers", type=int, default=4, help='number of decoding processes')
+	parser.add_argument("--seed", type=int, default=0, help='seed of the sampling of the patches')
+	argspar = parser.parse_args()
+
+	main(**vars(argspar))
@@ -0,0 +1,194 @@
+"""
+Post-training static int8 quantization of a FastDVDnet model for CPU inference.
+
+The BN layers of the model are first folded into the convolutions. The model is
+then quantized with the FX graph mode quantization of PyTorch (per-channel int8
+weights, per-tensor int8 activations) after calibration on noisy sequences. The
+quantized model is saved as TorchScript and can be run by denoise_seq_fastdvdnet().
+
+This program is free software: you can use, modify and/or
+redistribute it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either
+version 3 of the License, or (at your option) any later
+version. You should have received a copy of this license along
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import time
+import torch
+from models import FastDVDnet, fold_batchnorm, fold_noise_map, num_input_frames_from_state_dict
+from fastdvdnet import denoise_seq_fastdvdnet
+from noise_models import add_noise, get_generator
+from dataset import ValDataset
+from utils import open_sequence, get_imagenames, batch_psnr, load_checkpoint_state_dict
+
+def get_quantization_backend():
+	'''Returns the quantized engine to use on this CPU: 'x86' if supported
+		(it picks the best kernels for AVX-512/VNNI hosts), else 'fbgemm'
+	'''
+	engines = torch.backends.quantized.supported_engines
+	if 'x86' in engines:
+		return 'x86'
+	return 'fbgemm'
+
+def load_sequences(seq_path, gray_mode=False, max_num_fr=15):
+	r"""Loads the sequences used for calibration and evaluation.
+
+	Args:
+		seq_path: either a folder with a single image sequence (opened with
+			utils.open_sequence) or a folder with one subfolder per sequence (opened
+			with dataset.ValDataset)
+		gray_mode: if True, open the sequences in grayscale mode
+		max_num_fr: maximum number of frames to load per sequence
+	Returns:
+		list of Tensors [num_frames, C, H, W] in the [0., 1.] range
+	"""
+	if get_imagenames(seq_path):
+		seq, _, _ = open_sequence(seq_path, gray_mode, expand_if_needed=False, \
+								  max_num_fr=max_num_fr)
+		return [torch.from_numpy(seq)]
+	dataset = ValDataset(valsetdir=seq_path, gray_mode=gray_mode, num_input_frames=max_num_fr)
+	return [dataset[idx] for idx in range(len(dataset))]
+
+def get_noisy_sequences(seqs, noise_std, seed=0):
+	'''Adds AWGN of standard deviation noise_std to each sequence of seqs (see
+		noise_models.add_noise()). The noise is drawn from a fixed seed so that
+		results are reproducible.
+	'''
+	gen = get_generator(seed, 'cpu')
+	return [add_noise(seq.unsqueeze(0), 'gaussian', noise_ival=(noise_std, noise_std), \
+					  generator=gen)[0][0] for seq in seqs]
+
+def quantize_fastdvdnet(model, calib_seqs, noise_std, backend=None):
+	r"""Quantizes a FastDVDnet model to int8 (static post-training quantization).
+
+	Args:
+		model: trained FastDVDnet instance, possibly wrapped by nn.DataParallel
+		calib_seqs: list of noisy Tensors [num_frames, C, H, W] used for calibration
+		noise_std: float, standard deviation of the noise of calib_seqs
+		backend: quantized engine, see get_quantization_backend()
+	Returns:
+		the quantized model (a torch.fx.GraphModule), running on CPU
+	"""
+	try:
+		from torch.ao.quantization import get_default_qconfig_mapping
+		from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+	except ImportError:
+		raise Exception('Quantization needs torch>=1.13, found {}'.format(torch.__version__))
+
+	if backend is None:
+		backend = get_quantization_backend()
+	torch.backends.quantized.engine = backend
+
+	# no BN layers nor data-dependent control flow in the traced graph
+	model = fold_noise_map(fold_batchnorm(model).cpu(), enable=False)
+	temp_psz = model.num_input_frames
+	C = calib_seqs[0].size(1)
+	example_inputs = (torch.rand((1, temp_psz*C, 64, 64)), torch.rand((1, 1, 64, 64)))
+	prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs)
+
+	# calibration: collect the range of the activations
+	sigma_noise = torch.FloatTensor([noise_std])
+	with torch.no_grad():
+		for seqn in calib_seqs:
+			denoise_seq_fastdvdnet(seq=seqn, noise_std=sigma_noise, temp_psz=temp_psz, \
+								   model_temporal=prepared)
+
+	return convert_fx(prepared)
+
+def compare_psnr_fp32_int8(model_fp32, model_int8, seqs, seqs_noisy, noise_std, temp_psz):
+	r"""Denoises the noisy sequences with both models and returns the average PSNRs
+	of the results and the average runtimes per frame.
+	"""
+	sigma_noise = torch.FloatTensor([noise_std])
+	results = {'psnr_fp32': 0., 'psnr_int8': 0., 'time_fp32': 0., 'time_int8': 0.}
+	num_frames = 0
+	with torch.no_grad():
+		# untimed warm-up of each model (one-off JIT and oneDNN initializations)
+		for model in (model_fp32, model_int8):
+			denoise_seq_fastdvdnet(seq=seqs_noisy[0][:temp_psz], noise_std=sigma_noise, \
+								   temp_psz=temp_psz, model_temporal=model)
+		for seq, seqn in zip(seqs, seqs_noisy):
+			for name, model in (('fp32', model_fp32), ('int8', model_int8)):
+				start_time = time.time()
+				out = denoise_seq_fastdvdnet(seq=seqn, noise_std=sigma_noise, \
+											 temp_psz=temp_psz, model_temporal=model)
+				results['time_' + name] += time.time() - start_time
+				results['psnr_' + name] += batch_psnr(out, seq, 1.)
+			num_frames += seq.size(0)
+	for name in ('fp32', 'int8'):
+		results['psnr_' + name] /= len(seqs)
+		results['time_' + name] /= num_frames
+	return results
+
+def main(**args):
+	r"""Quantizes a trained model, reports the PSNR delta against fp32 and saves
+	the quantized model as TorchScript
+	"""
+	if args['num_threads'] > 0:
+		torch.set_num_threads(args['num_threads'])
+
+	# Load fp32 model
+	state_dict = load_checkpoint_state_dict(args['model_file'], map_location='cpu')
+	temp_psz = num_input_frames_from_state_dict(state_dict)
+	model_fp32 = FastDVDnet(num_input_frames=temp_psz)
+	model_fp32.load_state_dict(state_dict)
+	model_fp32.eval()
+
+	# Load data and quantize
+	seqs = load_sequences(args['calib_path'], args['gray'], args['max_num_fr_per_seq'])
+	seqs_noisy = get_noisy_sequences(seqs, args['noise_sigma'])
+	print('Calibrating on {} sequences ...'.format(len(seqs)))
+	model_int8 = quantize_fastdvdnet(model_fp32, seqs_noisy, args['noise_sigma'], \
+									 args['qbackend'])
+
+	# Compare against fp32 on the same data
+	if args['eval_path'] is not None:
+		seqs = load_sequences(args['eval_path'], args['gray'], args['max_num_fr_per_seq'])
+		seqs_noisy = get_noisy_sequences(seqs, args['noise_sigma'], seed=1)
+	res = compare_psnr_fp32_int8(model_fp32, model_int8, seqs, seqs_noisy, \
+								 args['noise_sigma'], temp_psz)
+	print('PSNR fp32 {:.4f}dB, PSNR int8 {:.4f}dB, delta {:.4f}dB'.\
+		  format(res['psnr_fp32'], res['psnr_int8'], res['psnr_int8']-res['psnr_fp32']))
+	print('Runtime per frame fp32 {:.3f}s, int8 {:.3f}s, speedup x{:.2f}'.\
+		  format(res['time_fp32'], res['time_int8'], res['time_fp32']/res['time_int8']))
+
+	# Save quantized model as TorchScript
+	C = seqs[0].size(1)
+	example_inputs = (torch.rand((1, temp_psz*C, 64, 64)), torch.rand((1, 1, 64, 64)))
+	with torch.no_grad():
+		scripted = torch.jit.trace(model_int8, example_inputs)
+	torch.jit.save(scripted, args['save_file'])
+	print('Saved quantized model to {}'.format(args['save_file']))
+
+if __name__ == "__main__":
+	# Parse arguments
+	parser = argparse.ArgumentParser(description="Quantize a FastDVDnet model to int8")
+	parser.add_argument("--model_file", type=str, default="./model.pth", \
+						help='path to model of the pretrained denoiser')
+	parser.add_argument("--calib_path", type=str, default=None, \
+						help='path to a sequence or a folder of sequences used for calibration')
+	parser.add_argument("--eval_path", type=str, default=None, \
+						help='path to the sequence(s) used to compare to fp32 (default: calib_path)')
+	parser.add_argument("--save_file", type=str, default="./model_int8.pt", \
+						help='where to save the quantized TorchScript model')
+	parser.add_argument("--max_num_fr_per_seq", type=int, default=15, \
+						help='max number of frames to load per sequence')
+	parser.add_argument("--noise_sigma", type=float, default=25, help='noise level')
+	parser.add_argument("--qbackend", type=str, default=None, \
+						help='quantized engine (x86, fbgemm). Default: best available')
+	parser.add_argument("--num_threads", type=int, default=0, \
+						help='number of CPU threads (default: PyTorch default)')
+	parser.add_argument("--gray", action='store_true',\
+						help='perform denoising of grayscale images instead of RGB')
+	argspar = parser.parse_args()
+	# Normalize noises ot [0, 1]
+	argspar.noise_sigma /= 255.
+
+	print("\n### Quantizing FastDVDnet model ###")
+	print("> Parameters:")
+	for p, v in zip(argspar.__dict__.keys(), argspar.__dict__.values()):
+		print('\t{}: {}'.format(p, v))
+	print('\n')
+
+	main(**vars(argspar))
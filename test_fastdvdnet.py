@@ -5,23 +5,58 @@ Denoise all the sequences existent in a given folder using FastDVDnet.
 @author: Matias Tassano <mtassano@parisdescartes.fr>
 """
 import os
+import copy
+import glob
 import argparse
 import time
+from collections import deque
 import cv2
 import torch
 import torch.nn as nn
-from models import FastDVDnet
-from fastdvdnet import denoise_seq_fastdvdnet
+import torch.multiprocessing as mp
+from models import FastDVDnet, fold_batchnorm, fold_noise_map, num_input_frames_from_state_dict
+from fastdvdnet import denoise_seq_fastdvdnet, denoise_seq_sharded, get_cpu_groups, \
+				create_shard_pool, denoise_stream_fastdvdnet, frames_to_float, prepare_cpu_inference, \
+				cpu_supports_bf16, cpu_autocast
+from compile_cache import load_or_compile, COMPILE_CACHE_DIR
+from onnx_backend import OnnxRuntimeModel
+from noise_models import add_noise, get_generator, NOISE_TYPES
+from frame_container import FrameContainerWriter, CONTAINEREXT
+from metrics import StreamingMetrics, batch_psnr as batch_psnr_torch
+from video_io import is_video_file, get_video_fps, get_video_num_frames, read_video_frames, \
+				VideoWriter
 from utils import batch_psnr, init_logger_test, \
-				variable_to_cv2_image, remove_dataparallel_wrapper, open_sequence, close_logger
-import sys
-NUM_IN_FR_EXT = 5 # temporal size of patch
+				variable_to_cv2_image, load_checkpoint_state_dict, open_sequence, close_logger, \
+				get_imagenames, FRAME_CACHE_DIR
 MC_ALGO = 'DeepFlow' # motion estimation algorithm
 OUTIMGEXT = '.png' # output images format
+MAXNUMFRSEQ = 25 # default max number of frames loaded per image sequence (videos are not capped)
+WORKER_STATE = None # models and arguments of a worker process of the folder mode
 
-def save_out_seq(seqnoisy, seqclean, save_dir, sigmaval, suffix, save_noisy):
+def save_out_container(seqnoisy, seqclean, save_dir, sigmaval, suffix, save_noisy, compress):
+	"""Saves the denoised and noisy sequences under save_dir as frame containers
+	"""
+	out_name = 'n{}_FastDVDnet'.format(sigmaval)
+	if len(suffix) != 0:
+		out_name += '_' + suffix
+	seqs = [(seqclean, out_name)]
+	if save_noisy:
+		seqs.append((seqnoisy, 'n{}'.format(sigmaval)))
+	for seq, name in seqs:
+		# same conversion to uint8 as variable_to_cv2_image()
+		frames = (seq.clamp(0., 1.)*255.).to(torch.uint8).cpu().numpy()
+		with FrameContainerWriter(os.path.join(save_dir, name + CONTAINEREXT), \
+								  *frames.shape[1:], compress=compress) as writer:
+			for frame in frames:
+				writer.write(frame)
+
+def save_out_seq(seqnoisy, seqclean, save_dir, sigmaval, suffix, save_noisy, out_format='png', \
+				 compress=False):
 	"""Saves the denoised and noisy sequences under save_dir
 	"""
+	if out_format == 'container':
+		save_out_container(seqnoisy, seqclean, save_dir, sigmaval, suffix, save_noisy, compress)
+		return
 	seq_len = seqnoisy.size()[0]
 	for idx in range(seq_len):
 		# Build Outname
@@ -43,21 +78,343 @@ def save_out_seq(seqnoisy, seqclean, save_dir, sigmaval, suffix, save_noisy):
 		outimg = variable_to_cv2_image(seqclean[idx].unsqueeze(dim=0))
 		cv2.imwrite(out_name, outimg)
 
+def load_models(args, device):
+	"""Creates the denoising model and loads its weights
+
+	Returns:
+		model_temp: the model used for denoising
+		num_in_fr: temporal size of patch of the model
+		model_ref: default fp32 model to compare the CPU performance mode to, or None
+	"""
+	model_ref = None
+
+	if args['onnx_model'] is not None:
+		# Run the exported ONNX graph with ONNX Runtime instead of PyTorch
+		print('Loading ONNX model ...')
+		model_temp = OnnxRuntimeModel(args['onnx_model'])
+		num_in_fr = model_temp.num_input_frames
+	else:
+		# Create models, the temporal size of patch is the one of the saved model
+		print('Loading models ...')
+		state_temp_dict = load_checkpoint_state_dict(args['model_file'], map_location=device)
+		num_in_fr = num_input_frames_from_state_dict(state_temp_dict)
+		model_temp = FastDVDnet(num_input_frames=num_in_fr)
+
+		# Load saved weights
+		model_temp.load_state_dict(state_temp_dict)
+
+		# Sets the model in evaluation mode (e.g. it removes BN)
+		model_temp.eval()
+		if args['fold_bn']:
+			# Fold the BN layers into the convolutions
+			model_temp = fold_batchnorm(model_temp)
+		if args['fold_noise_map']:
+			# Precompute the contribution of the (constant) noise map
+			fold_noise_map(model_temp)
+
+		if args['cpu_perf']:
+			# Keep the default fp32 model to report the PSNR delta of the CPU perf mode
+			model_ref = copy.deepcopy(model_temp)
+			model_temp = prepare_cpu_inference(model_temp)
+
+		if args['cuda']:
+			device_ids = [0]
+			model_temp = nn.DataParallel(model_temp, device_ids=device_ids).cuda()
+
+	return model_temp, num_in_fr, model_ref
+
+def denoise_sequence(seq_dir, model_temp, num_in_fr, model_ref, device, args, save_dir, \
+					 shard_pool=None):
+	"""Opens the sequence stored in seq_dir, adds noise to it and denoises it.
+	The results are saved under save_dir. With num_shards > 1, the sequence is
+	denoised by the workers of shard_pool (see fastdvdnet.create_shard_pool()).
+
+	Returns:
+		results: dict with the PSNRs of the noisy and denoised sequences and the
+			loading and denoising times
+	"""
+	# Start time
+	start_time = time.time()
+
+	# CPU performance mode: bf16 autocast if supported
+	use_bf16 = args['cpu_perf'] and args['bf16'] and cpu_supports_bf16()
+
+	with torch.no_grad():
+		# process data
+		seq, _, _ = open_sequence(seq_dir,\
+									args['gray'],\
+									expand_if_needed=False,\
+									max_num_fr=args['max_num_fr_per_seq'] or MAXNUMFRSEQ,\
+									num_workers=args['load_workers'],\
+									cache_dir=args['frame_cache'])
+		seq = torch.from_numpy(seq).to(device)
+
+		# Load the model compiled for this resolution, or compile and cache it
+		if args['compile_cache'] is not None:
+			model_temp = load_or_compile(model_temp, seq.size(-2), seq.size(-1), device, \
+										 cache_dir=args['compile_cache'], num_channels=seq.size(1))
+		seq_time = time.time()
+
+		# Add noise, the noise std of the sequence is the one of its noise map
+		seqn, noisestd = add_noise(seq.unsqueeze(0), args['type_noise'], \
+								   noise_ival=(args['noise_sigma'], args['noise_sigma']), \
+								   poisson_peak=args['poisson_peak'], \
+								   sp_amount=args['sp_amount'], \
+								   speckle_var=args['speckle_var'], \
+								   generator=get_generator(args['noise_seed'], device))
+		seqn = seqn.squeeze(0)
+		noisestd = noisestd.view(1)
+
+		# metrics of the denoised frames, updated as they are computed. The PSNR is
+		# computed afterwards on CPU with skimage_psnr
+		metrics = StreamingMetrics(ssim=args['ssim'], psnr=not args['skimage_psnr'])
+		def update_metrics(fridx, frames):
+			metrics.update(frames, seq[fridx:fridx+frames.size(0)])
+		frame_callback = update_metrics if metrics.enabled() else None
+
+		denoise_args = {'temp_psz': num_in_fr, \
+						'cache_stage1': args['cache_stage1'], \
+						'batch_size': args['batch_size'], \
+						'tile_size': args['tile_size'], \
+						'tile_overlap': args['tile_overlap'], \
+						'tile_workers': args['tile_workers']}
+		if args['num_shards'] > 1:
+			# split the sequence in time between worker processes
+			del denoise_args['cache_stage1'] # rejected in test_fastdvdnet()
+			cpu_groups = get_cpu_groups(args['num_shards']) if args['pin_cpus'] else None
+			denframes = denoise_seq_sharded(seq=seqn,\
+											noise_std=noisestd,\
+											model_temporal=model_temp,\
+											num_shards=args['num_shards'],\
+											channels_last=args['cpu_perf'],\
+											cpu_groups=cpu_groups,\
+											bf16=use_bf16,\
+											pool=shard_pool,\
+											**denoise_args)
+			if frame_callback is not None:
+				frame_callback(0, denframes)
+		else:
+			with cpu_autocast(use_bf16):
+				denframes = denoise_seq_fastdvdnet(seq=seqn,\
+												noise_std=noisestd,\
+												model_temporal=model_temp,\
+												channels_last=args['cpu_perf'],\
+												frame_callback=frame_callback,\
+												**denoise_args)
+
+	# Compute PSNR, with skimage to reproduce previous results if required
+	stop_time = time.time()
+	psnr_fn = batch_psnr if args['skimage_psnr'] else batch_psnr_torch
+	results = {'seq_dir': seq_dir, \
+			   'num_frames': seq.size()[0], \
+			   'psnr': psnr_fn(denframes, seq, 1.) if args['skimage_psnr'] else metrics.psnr(), \
+			   'psnr_noisy': psnr_fn(seqn.squeeze(), seq, 1.), \
+			   'ssim': metrics.ssim(), \
+			   'loadtime': seq_time - start_time, \
+			   'runtime': stop_time - seq_time, \
+			   'psnr_delta_perf': None, \
+			   'max_abs_diff': None}
+
+	# Compare the CPU performance mode to the default fp32 model
+	if model_ref is not None:
+		with torch.no_grad():
+			denframes_ref = denoise_seq_fastdvdnet(seq=seqn,\
+												noise_std=noisestd,\
+												model_temporal=model_ref,\
+												**denoise_args)
+		results['psnr_delta_perf'] = results['psnr'] - psnr_fn(denframes_ref, seq, 1.)
+		del denframes_ref
+
+	# Compare to the plain path: no tiling, no caching nor sharding, one window per batch
+	if args['check_parity']:
+		with torch.no_grad():
+			denframes_plain = denoise_seq_fastdvdnet(seq=seqn,\
+													noise_std=noisestd,\
+													temp_psz=num_in_fr,\
+													model_temporal=model_temp)
+		results['max_abs_diff'] = (denframes - denframes_plain).abs().max().item()
+		del denframes_plain
+
+	# Save outputs
+	if not args['dont_save_results']:
+		# Save sequence
+		if not os.path.exists(save_dir):
+			os.makedirs(save_dir)
+		save_out_seq(seqn, denframes, save_dir, \
+					   int(args['noise_sigma']*255), args['suffix'], args['save_noisy'], \
+					   args['out_format'], args['compress'])
+
+	return results
+
+def to_uint8(frame):
+	"""Converts a frame in [0, 1] to uint8 as variable_to_cv2_image() does
+	"""
+	return (frame.clamp(0., 1.)*255.).to(torch.uint8).cpu().numpy()
+
+def denoise_video(video_path, model_temp, num_in_fr, device, args):
+	"""Denoises the frames of a video file as they are decoded, and encodes the
+	result to save_path. Only the frames of the current temporal window are kept
+	in memory.
+
+	Returns:
+		results: dict with the PSNRs of the noisy and denoised frames (None if the
+			noise is not synthetic), the denoising time and the number of frames
+			left out because of max_num_fr_per_seq
+	"""
+	start_time = time.time()
+	use_bf16 = args['cpu_perf'] and args['bf16'] and cpu_supports_bf16()
+	generator = get_generator(args['noise_seed'], device)
+	clean_frames = deque() # clean and noisy frames not denoised yet
+	noisy_frames = deque()
+
+	def get_noisy_frames():
+		# frames and the std of their noise, which is the one returned by add_noise()
+		# as in denoise_sequence(), computed frame by frame
+		for frame in read_video_frames(video_path, args['gray'], args['max_num_fr_per_seq']):
+			frame = frames_to_float(torch.from_numpy(frame).to(device))
+			noisestd = torch.FloatTensor([args['noise_sigma']]).to(device)
+			if not args['noisy_input']:
+				clean_frames.append(frame)
+				frame, noisestd = add_noise(frame.unsqueeze(0), args['type_noise'], \
+											noise_ival=(args['noise_sigma'], args['noise_sigma']), \
+											poisson_peak=args['poisson_peak'], \
+											sp_amount=args['sp_amount'], \
+											speckle_var=args['speckle_var'], \
+											generator=generator)
+				frame = frame[0]
+			noisy_frames.append(frame)
+			yield frame, noisestd.view(1)
+
+	name = os.path.splitext(os.path.basename(video_path))[0]
+	suffix = '_' + args['suffix'] if len(args['suffix']) != 0 else ''
+	fps = get_video_fps(video_path)
+	out_video = VideoWriter(os.path.join(args['save_path'], \
+										 '{}_FastDVDnet{}.mp4'.format(name, suffix)), fps)
+	noisy_video = VideoWriter(os.path.join(args['save_path'], '{}_noisy.mp4'.format(name)), fps) \
+				  if args['save_noisy'] and not args['dont_save_results'] else None
+
+	num_frames = 0
+	metrics = StreamingMetrics(ssim=args['ssim'])
+	metrics_noisy = StreamingMetrics()
+	with torch.no_grad(), cpu_autocast(use_bf16):
+		for denframe in denoise_stream_fastdvdnet(get_noisy_frames(), None, num_in_fr, \
+												  model_temp, tile_size=args['tile_size'], \
+												  tile_overlap=args['tile_overlap'], \
+												  tile_workers=args['tile_workers'], \
+												  channels_last=args['cpu_perf']):
+			noisyframe = noisy_frames.popleft()
+			if not args['noisy_input']:
+				cleanframe = clean_frames.popleft().unsqueeze(0)
+				metrics.update(denframe.unsqueeze(0), cleanframe)
+				metrics_noisy.update(noisyframe.unsqueeze(0), cleanframe)
+			if not args['dont_save_results']:
+				out_video.write(to_uint8(denframe))
+				if noisy_video is not None:
+					noisy_video.write(to_uint8(noisyframe))
+			num_frames += 1
+	out_video.close()
+	if noisy_video is not None:
+		noisy_video.close()
+
+	return {'seq_dir': video_path, \
+			'num_frames': num_frames, \
+			'psnr': None if args['noisy_input'] else metrics.psnr(), \
+			'psnr_noisy': None if args['noisy_input'] else metrics_noisy.psnr(), \
+			'ssim': None if args['noisy_input'] else metrics.ssim(), \
+			'loadtime': 0., \
+			'runtime': time.time() - start_time, \
+			'psnr_delta_perf': None, \
+			'max_abs_diff': None, \
+			'num_dropped_frames': max(get_video_num_frames(video_path) - num_frames, 0) \
+								  if args['max_num_fr_per_seq'] is not None else 0}
+
+def log_results(logger, results):
+	"""Logs the results of denoise_sequence()
+	"""
+	logger.info("Finished denoising {}".format(results['seq_dir']))
+	logger.info("\tDenoised {} frames in {:.3f}s ({:.2f} frames/s), loaded seq in {:.3f}s".\
+				 format(results['num_frames'], results['runtime'], \
+						results['num_frames']/results['runtime'], results['loadtime']))
+	if results['psnr'] is not None:
+		logger.info("\tPSNR noisy {:.4f}dB, PSNR result {:.4f}dB".\
+					format(results['psnr_noisy'], results['psnr']))
+	if results['ssim'] is not None:
+		logger.info("\tSSIM result {:.4f}".format(results['ssim']))
+	if results['psnr_delta_perf'] is not None:
+		logger.info("\tCPU perf mode: PSNR delta vs fp32 {:.4f}dB".format(results['psnr_delta_perf']))
+	if results['max_abs_diff'] is not None:
+		logger.info("\tMax abs difference vs the plain path {:.3e}".format(results['max_abs_diff']))
+	if results.get('num_dropped_frames'):
+		logger.warning("\tLeft out the last {} frames (max_num_fr_per_seq={})".\
+					   format(results['num_dropped_frames'], results['num_frames']))
+
+def get_sequence_dirs(test_path):
+	"""Returns the sorted list of the subfolders of test_path containing an image sequence
+	"""
+	return [seq_dir for seq_dir in sorted(glob.glob(os.path.join(test_path, '*'))) \
+			if os.path.isdir(seq_dir) and get_imagenames(seq_dir)]
+
+def init_worker(model_temp, num_in_fr, model_ref, args, num_threads):
+	"""Initializes a worker process of the folder mode. The weights of the models
+	are shared with the main process
+	"""
+	global WORKER_STATE
+	torch.set_num_threads(num_threads)
+	if model_temp is None:
+		# ONNX Runtime sessions can't be shared between processes
+		model_temp = OnnxRuntimeModel(args['onnx_model'], num_threads=num_threads)
+	WORKER_STATE = (model_temp, num_in_fr, model_ref, args)
+
+def denoise_sequence_worker(seq_dir):
+	"""Denoises a sequence in a worker process of the folder mode
+	"""
+	model_temp, num_in_fr, model_ref, args = WORKER_STATE
+	return denoise_sequence(seq_dir, model_temp, num_in_fr, model_ref, torch.device('cpu'), args, \
+							os.path.join(args['save_path'], os.path.basename(seq_dir)))
+
 def test_fastdvdnet(**args):
 	"""Denoises all sequences present in a given folder. Sequences must be stored as numbered
 	image sequences. The different sequences must be stored in subfolders under the "test_path" folder.
+	Without "all_sequences", "test_path" is the folder of a single sequence.
 
 	Inputs:
 		args (dict) fields:
 			"model_file": path to model
 			"test_path": path to sequence to denoise
 			"suffix": suffix to add to output name
-			"max_num_fr_per_seq": max number of frames to load per sequence
+			"max_num_fr_per_seq": max number of frames to load per sequence. If None,
+				MAXNUMFRSEQ for image sequences and all the frames of a video
 			"noise_sigma": noise level used on test set
+			"type_noise": type of the noise added to the sequence (see noise_models.py)
+			"poisson_peak", "sp_amount", "speckle_var": parameters of the noise
+			"noise_seed": if not None, seed of the noise
 			"dont_save_results: if True, don't save output images
 			"no_gpu": if True, run model on CPU
 			"save_path": where to save outputs as png
 			"gray": if True, perform denoising of grayscale images instead of RGB
+			"cache_stage1": if True, reuse first-stage results of overlapping windows
+			"batch_size": number of temporal windows denoised per forward pass
+			"tile_size": if not None, run the model on overlapping tiles of this size
+			"tile_overlap": minimum overlap between tiles
+			"tile_workers": number of tiles processed concurrently
+			"fold_bn": if True, fold the BN layers into the convolutions
+			"fold_noise_map": if True, precompute the contribution of the noise map
+			"compile_cache": if not None, directory of the cache of compiled models
+			"onnx_model": if not None, ONNX model to run with ONNX Runtime
+			"cpu_perf": if True, run on CPU with channels_last and report the PSNR delta
+			"bf16": if True, use bfloat16 autocast in the CPU performance mode
+			"all_sequences": if True, denoise every sequence in the subfolders of test_path
+			"num_workers": number of worker processes denoising sequences in parallel (CPU only)
+			"num_shards": number of worker processes denoising parts of each sequence (CPU only)
+			"pin_cpus": if True, pin each shard worker to its own group of CPUs
+			"load_workers": number of threads decoding the frames of a sequence
+			"frame_cache": if not None, directory of the cache of decoded sequences
+			"out_format": 'png' (one file per frame) or 'container' (see frame_container.py)
+			"compress": if True, compress the chunks of the containers
+			"noisy_input": if True, don't add noise to a video given as test_path
+			"ssim": if True, also compute the SSIM of the results
+			"skimage_psnr": if True, compute the PSNRs with skimage instead of PyTorch
+			"check_parity": if True, also denoise with the plain path and report the max abs difference
 	"""
 	# Start time
 	start_time = time.time()
@@ -72,112 +429,94 @@ def test_fastdvdnet(**args):
 		device = torch.device('cuda')
 	else:
 		device = torch.device('cpu')
+	args['cpu_perf'] = args['cpu_perf'] and not args['cuda']
+	if is_video_file(args['test_path']):
+		# the frames of videos are denoised one at a time, as a stream
+		ignored = [flag for flag, used in (('--batch_size', args['batch_size'] > 1), \
+										   ('--cache_stage1', args['cache_stage1']), \
+										   ('--compile_cache', args['compile_cache'] is not None), \
+										   ('--num_shards', args['num_shards'] > 1), \
+										   ('--out_format', args['out_format'] != 'png'), \
+										   ('--frame_cache', args['frame_cache'] is not None), \
+										   ('--skimage_psnr', args['skimage_psnr']), \
+									   ('--check_parity', args['check_parity'])) if used]
+		if ignored:
+			raise Exception('{} not available when test_path is a video'.format(', '.join(ignored)))
+	if args['compile_cache'] is not None and args['cache_stage1']:
+		raise Exception('--cache_stage1 runs the stages of the eager model, it cannot be used '\
+						'with --compile_cache')
+	if args['num_shards'] > 1:
+		if args['cuda'] or args['onnx_model'] is not None or args['compile_cache'] is not None:
+			raise Exception('--num_shards needs a PyTorch model running on CPU')
+		if args['all_sequences'] and args['num_workers'] > 1:
+			raise Exception('--num_shards and --num_workers cannot be used together')
+		if args['cache_stage1']:
+			raise Exception('--cache_stage1 is not available with --num_shards')
 
-	# Create models
-	print('Loading models ...')
-	model_temp = FastDVDnet(num_input_frames=NUM_IN_FR_EXT)
+	model_temp, num_in_fr, model_ref = load_models(args, device)
 
-	# Load saved weights
-	state_temp_dict = torch.load(args['model_file'], map_location=device)
-	if args['cuda']:
-		device_ids = [0]
-		model_temp = nn.DataParallel(model_temp, device_ids=device_ids).cuda()
-	else:
-		# CPU mode: remove the DataParallel wrapper
-		state_temp_dict = remove_dataparallel_wrapper(state_temp_dict)
-	model_temp.load_state_dict(state_temp_dict)
+	if is_video_file(args['test_path']):
+		# decode, denoise and encode the video frame by frame
+		log_results(logger, denoise_video(args['test_path'], model_temp, num_in_fr, device, args))
+		close_logger(logger)
+		return
 
-	# Sets the model in evaluation mode (e.g. it removes BN)
-	model_temp.eval()
+	# the shard workers are started once and denoise every sequence
+	shard_pool = create_shard_pool(model_temp, args['num_shards']) if args['num_shards'] > 1 else None
 
-	with torch.no_grad():
-		# process data
-		seq, _, _ = open_sequence(args['test_path'],\
-									args['gray'],\
-									expand_if_needed=False,\
-									max_num_fr=args['max_num_fr_per_seq'])
-		seq = torch.from_numpy(seq).to(device)
-		seq_time = time.time()
+	if not args['all_sequences']:
+		log_results(logger, denoise_sequence(args['test_path'], model_temp, num_in_fr, model_ref, \
+											 device, args, args['save_path'], shard_pool))
+		if shard_pool is not None:
+			shard_pool.close()
+			shard_pool.join()
+		close_logger(logger)
+		return
 
-		# Add noise
-
-		#
-		if args['type_noise']=="gaussian":        
-                    noise = torch.empty_like(seq).normal_(mean=0, std=args['noise_sigma']).to(device)
-                    seq + noise
-                    std = torch.FloatTensor([args['noise_sigma']]).to(device)
-        #
-		if args['type_noise']=="uniform":
-# std dev of each sequence
-                    stdn = torch.empty((N, 1, 1, 1)).cuda().uniform_(args['noise_ival'][0], to=args['noise_ival'][1])
-# draw noise samples from std dev tensor
-                    v_max=np.sqrt(3)*stdn
-                    noise = torch.empty((N,L,H,W)).cuda().uniform(-1,to=1)
-                    # Pytorch accept? 
-                    noise2 = noise*stdn.expand_as(noise)
-                    noise = torch.empty((N,L,H,W)).cuda().uniform(-1,to=1)*stdn.expand_as(noise)*np.sqrt(3).cuda()
-                    for img_du_batch in range(N):
-                        noise2[img_du_batch,:,:,:] = noise2[img_du_batch,:,:,:]*v_max[img_du_batch,1,1,1]
-                    print(noise-noise2)
-                    
-                    plt.imshow(imgn_train[1,0:3,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig1_gauss.png")
-                    sys.exit()                                    
-		if args['type_noise']=="poisson":
-                    peak=args['poisson_peak']
-                    imgn_train = torch.poisson(img_train /255 * peak ) / float(peak) *255
-                    noise=imgn_train-img_train
-                    std=torch.std(noise,unbiased=True)
-                    mean=torch.mean(noise)
-                    stdn = torch.empty((N, 1, 1, 1)).cuda().normal_(mean=mean,std=std)
-                    plt.imshow(imgn_train[1,0:3,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig1_poisson.png")
-                    sys.exit()
-		if args['type_noise']=="s&p":
-                    s_vs_p = 0.5
-                    # Salt mode
-                    imgn_train = torch.tensor(random_noise(img_train.cpu(), mode='s&p', salt_vs_pepper=s_vs_p, clip=True)).cuda()
-                    noise=imgn_train-img_train
-                    stdn = torch.empty((N, 1, 1, 1)).cuda()
-                    for img_du_batch in range(N):
-                        stdn[img_du_batch,:,:,:]=torch.std(noise[img_du_batch,:,:,:],unbiased=True) 
-#                                    plt.imshow(imgn_train[1,0:3,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-#                                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig1_s&p.png")
-#                                    sys.exit()
-            
-		if args['type_noise']=="speckle":
-                    varia=args['speckle_var']
-                    imgn_train = torch.tensor(random_noise(img_train.cpu(), mode='speckle', mean=0, var=varia, clip=True)).cuda().float()
-                    noise=imgn_train-img_train
-                    stdn = torch.empty((N, 1, 1, 1)).cuda()
-                    for img_du_batch in range(N):
-                        stdn[img_du_batch,:,:,:]=torch.std(noise[img_du_batch,:,:,:],unbiased=True) 
-#                                    plt.imshow(imgn_train[1,0:3,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-#                                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig1_speckle.png")
-#                                    sys.exit()                        
-
-		denframes = denoise_seq_fastdvdnet(seq=seqn,\
-										noise_std=noisestd,\
-										temp_psz=NUM_IN_FR_EXT,\
-										model_temporal=model_temp)
-
-	# Compute PSNR and log it
-	stop_time = time.time()
-	psnr = batch_psnr(denframes, seq, 1.)
-	psnr_noisy = batch_psnr(seqn.squeeze(), seq, 1.)
-	loadtime = (seq_time - start_time)
-	runtime = (stop_time - seq_time)
-	seq_length = seq.size()[0]
-	logger.info("Finished denoising {}".format(args['test_path']))
-	logger.info("\tDenoised {} frames in {:.3f}s, loaded seq in {:.3f}s".\
-				 format(seq_length, runtime, loadtime))
-	logger.info("\tPSNR noisy {:.4f}dB, PSNR result {:.4f}dB".format(psnr_noisy, psnr))
+	# Folder mode
+	seq_dirs = get_sequence_dirs(args['test_path'])
+	num_workers = 1 if args['cuda'] else max(min(args['num_workers'], len(seq_dirs)), 1)
+	print('Denoising {} sequences with {} worker(s) ...'.format(len(seq_dirs), num_workers))
+	all_results = []
+	if num_workers > 1:
+		# the CPU threads are split between the workers, which share the weights
+		num_threads = max(torch.get_num_threads() // num_workers, 1)
+		for model in (model_temp, model_ref):
+			if isinstance(model, nn.Module):
+				model.share_memory()
+		if isinstance(model_temp, OnnxRuntimeModel):
+			model_temp = None
+		ctx = mp.get_context('spawn')
+		with ctx.Pool(num_workers, initializer=init_worker, \
+					  initargs=(model_temp, num_in_fr, model_ref, args, num_threads)) as pool:
+			for results in pool.imap(denoise_sequence_worker, seq_dirs):
+				log_results(logger, results)
+				all_results.append(results)
+	else:
+		for seq_dir in seq_dirs:
+			results = denoise_sequence(seq_dir, model_temp, num_in_fr, model_ref, device, args, \
+									   os.path.join(args['save_path'], os.path.basename(seq_dir)), \
+									   shard_pool)
+			log_results(logger, results)
+			all_results.append(results)
+	if shard_pool is not None:
+		shard_pool.close()
+		shard_pool.join()
 
-	# Save outputs
-	if not args['dont_save_results']:
-		# Save sequence
-		save_out_seq(seqn, denframes, args['save_path'], \
-					   int(args['noise_sigma']*255), args['suffix'], args['save_noisy'])
+	# Report over all sequences
+	if all_results:
+		num_frames = sum(res['num_frames'] for res in all_results)
+		logger.info("Finished denoising {} sequences ({} frames) in {:.3f}s".\
+					format(len(all_results), num_frames, time.time()-start_time))
+		logger.info("\tAverage PSNR noisy {:.4f}dB, average PSNR result {:.4f}dB".\
+					format(sum(res['psnr_noisy'] for res in all_results)/len(all_results), \
+						   sum(res['psnr'] for res in all_results)/len(all_results)))
+		if args['ssim']:
+			logger.info("\tAverage SSIM result {:.4f}".\
+						format(sum(res['ssim'] for res in all_results)/len(all_results)))
+		logger.info("\tTotal denoising time {:.3f}s, total loading time {:.3f}s".\
+					format(sum(res['runtime'] for res in all_results), \
+						   sum(res['loadtime'] for res in all_results)))
 
 	# close logger
 	close_logger(logger)
@@ -189,18 +528,80 @@ if __name__ == "__main__":
 						default="./model.pth", \
 						help='path to model of the pretrained denoiser')
 	parser.add_argument("--test_path", type=str, default="./data/rgb/Kodak24", \
-						help='path to sequence to denoise')
+						help='path to sequence to denoise (or to a folder of sequences with --all_sequences, '\
+						'or to a video file)')
 	parser.add_argument("--suffix", type=str, default="", help='suffix to add to output name')
-	parser.add_argument("--max_num_fr_per_seq", type=int, default=25, \
-						help='max number of frames to load per sequence')
+	parser.add_argument("--max_num_fr_per_seq", type=int, default=None, \
+						help='max number of frames to load per sequence (default: {} for image '\
+						'sequences, all the frames of a video)'.format(MAXNUMFRSEQ))
 	parser.add_argument("--noise_sigma", type=float, default=25, help='noise level used on test set')
+	parser.add_argument("--type_noise", type=str, default="gaussian", choices=NOISE_TYPES, \
+						help='type of the noise: {}. noise_sigma is the std of the gaussian and '\
+						'uniform noises'.format(', '.join(NOISE_TYPES)))
+	parser.add_argument("--poisson_peak", type=float, default=25.0, help='peak of the poisson noise')
+	parser.add_argument("--sp_amount", type=float, default=0.05, \
+						help='proportion of values replaced by the salt and pepper noise')
+	parser.add_argument("--speckle_var", type=float, default=0.05, help='variance of the speckle noise')
+	parser.add_argument("--noise_seed", type=int, default=None, help='seed of the noise')
+	parser.add_argument("--noisy_input", action='store_true', \
+						help="denoise a video given as test_path as is, without adding noise")
+	parser.add_argument("--ssim", action='store_true', help='also compute the SSIM of the results')
+	parser.add_argument("--skimage_psnr", action='store_true', \
+						help='compute the PSNRs on CPU with skimage (as in previous versions)')
+	parser.add_argument("--check_parity", action='store_true', \
+						help='also denoise each sequence without tiling, caching, sharding nor batching '\
+						'and report the max abs difference of the results')
 	parser.add_argument("--dont_save_results", action='store_true', help="don't save output images")
 	parser.add_argument("--save_noisy", action='store_true', help="save noisy frames")
+	parser.add_argument("--out_format", type=str, default='png', choices=['png', 'container'], \
+						help='save each frame as PNG, or each sequence as a single frame container')
+	parser.add_argument("--compress", action='store_true', \
+						help='compress the chunks of the frame containers (zlib)')
 	parser.add_argument("--no_gpu", action='store_true', help="run model on CPU")
 	parser.add_argument("--save_path", type=str, default='./results', \
 						 help='where to save outputs as png')
 	parser.add_argument("--gray", action='store_true',\
 						help='perform denoising of grayscale images instead of RGB')
+	parser.add_argument("--cache_stage1", action='store_true',\
+						help='reuse first-stage results shared by consecutive windows')
+	parser.add_argument("--batch_size", type=int, default=1,\
+						help='number of temporal windows denoised per forward pass')
+	parser.add_argument("--tile_size", type=int, default=None,\
+						help='run the model on overlapping tiles of this size (multiple of 4)')
+	parser.add_argument("--tile_overlap", type=int, default=16,\
+						help='minimum overlap between tiles (multiple of 4)')
+	parser.add_argument("--tile_workers", type=int, default=1,\
+						help='number of tiles processed concurrently')
+	parser.add_argument("--fold_bn", action='store_true',\
+						help='fold the BN layers into the convolutions for faster inference')
+	parser.add_argument("--fold_noise_map", action='store_true',\
+						help='precompute the contribution of the constant noise map')
+	parser.add_argument("--compile_cache", type=str, nargs='?', default=None, \
+						const=COMPILE_CACHE_DIR, \
+						help='run a TorchScript model compiled for the input resolution, cached '\
+						'in this directory (default: {})'.format(COMPILE_CACHE_DIR))
+	parser.add_argument("--onnx_model", type=str, default=None, \
+						help='path to an ONNX model exported with onnx_backend.py, run with '\
+						'ONNX Runtime instead of PyTorch')
+	parser.add_argument("--cpu_perf", action='store_true', \
+						help='CPU performance mode: channels_last memory layout. '\
+						'Reports the PSNR delta against the default fp32 model')
+	parser.add_argument("--bf16", action='store_true', \
+						help='use bfloat16 autocast in the CPU performance mode, if the CPU supports it')
+	parser.add_argument("--all_sequences", action='store_true', \
+						help='denoise every sequence stored in a subfolder of test_path')
+	parser.add_argument("--num_workers", type=int, default=1, \
+						help='number of processes denoising sequences in parallel with --all_sequences (CPU only)')
+	parser.add_argument("--num_shards", type=int, default=1, \
+						help='number of processes denoising contiguous parts of each sequence (CPU only)')
+	parser.add_argument("--pin_cpus", action='store_true', \
+						help='pin each of the --num_shards processes to its own group of CPUs')
+	parser.add_argument("--load_workers", type=int, default=None, \
+						help='number of threads decoding the frames (default: number of CPUs)')
+	parser.add_argument("--frame_cache", type=str, nargs='?', default=None, \
+						const=FRAME_CACHE_DIR, \
+						help='memory-map the decoded sequences from a cache in this directory, '\
+						'decoding them only once (default: {})'.format(FRAME_CACHE_DIR))
 
 	argspar = parser.parse_args()
 	# Normalize noises ot [0, 1]
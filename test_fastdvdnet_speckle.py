@@ -12,11 +12,11 @@ import torch
 import torch.nn as nn
 from models import FastDVDnet
 from fastdvdnet import denoise_seq_fastdvdnet
+from noise_models import add_noise
 from utils import batch_psnr, init_logger_test, \
 				variable_to_cv2_image, remove_dataparallel_wrapper, open_sequence, close_logger
 import sys
 import numpy as np
-from skimage.util import random_noise
 import matplotlib.pyplot as plt
 from skimage.measure.simple_metrics import compare_psnr
 
@@ -121,67 +121,19 @@ def test_fastdvdnet(**args):
 
 		#
 		N, L, H, W = seq.size()
-		if args['type_noise']=="gaussian":        
-                    noise = torch.empty_like(seq).normal_(mean=0, std=args['noise_sigma']).to(device)
-                    seqn = seq + noise
-                    noisestd = torch.FloatTensor([args['noise_sigma']]).to(device)
-        #
-		if args['type_noise']=="uniform":
-# std dev of each sequence
-                    stdn = torch.empty((N, 1, 1, 1)).cuda().uniform_(args['uniform_noise_ival'][0], to=args['uniform_noise_ival'][1]).to(device)
-                    #v_max=np.sqrt(3)*stdn
-                    #print("v_max shape",v_max.shape)
-                    #noise = torch.empty((N,L,H,W)).cuda().uniform_(-1,to=1)
-                    # Pytorch accept? 
-                    #noise2 = noise*stdn.expand_as(noise)
-                    noise = (torch.empty((N,L,H,W)).cuda().uniform_(-1,to=1)*stdn.expand_as(torch.empty((N,L,H,W)).cuda())*np.sqrt(3)).to(device)
-                    #for img_du_batch in range(N):
-                    #    noise2[img_du_batch,:,:,:] = noise2[img_du_batch,:,:,:]*v_max[img_du_batch]
-                    #print(noise-noise2)
-                    noisestd=torch.std(noise, unbiased=False).to(device)
-                    seqn=seq+noise
-#                    plt.imshow(seqn[1,:,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-#                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig3.png")
-#                    sys.exit()                                
-                    
-
-
-#		if args['type_noise']=="poisson":
-#                    peak=args['poisson_peak']
-#                    seqn = torch.poisson(seq  * peak ).to(device) / float(peak) 
-#                    noise=seqn-seq
-#                    noisestd=torch.std(noise,unbiased=True).to(device)
-#                    plt.imshow(seqn[1,:,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-#                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig3.png")
-#                    sys.exit()  
-		if args['type_noise']=="s&p":
-                    s_vs_p = 0.5
-                    # Salt mode
-                    tiers=round(N/3)
-                    deuxtiers=2*round(N/3)
-                    seq1=seq[0:tiers,:,:,:]
-                    seq2=seq[tiers:deuxtiers,:,:,:]
-                    seq3=seq[deuxtiers:N,:,:,:]
-                    seqn1 = torch.tensor(random_noise(seq1.cpu(), mode='s&p', salt_vs_pepper=s_vs_p, clip=True)).cuda().to(device)
-                    seqn2 = torch.tensor(random_noise(seq2.cpu(), mode='s&p', salt_vs_pepper=s_vs_p, clip=True)).cuda().to(device)
-                    seqn3 = torch.tensor(random_noise(seq3.cpu(), mode='s&p', salt_vs_pepper=s_vs_p, clip=True)).cuda().to(device)
-                    seqn=torch.cat([seqn1,seqn2,seqn3],0)
-                    noise=seqn-seq
-                    noisestd=torch.std(noise, unbiased=False).to(device)
-#                    sys.exit()
-
-		if args['type_noise']=="speckle":
-                    varia=args['speckle_var']
-                    milieu=round(N/2)
-                    seq1=seq[0:milieu,:,:,:]
-                    seq2=seq[milieu:N,:,:,:]
-                    seqn1 = torch.tensor(random_noise(seq1.cpu(), mode='speckle', mean=0, var=varia, clip=True)).cuda().float().to(device)
-                    seqn2 = torch.tensor(random_noise(seq2.cpu(), mode='speckle', mean=0, var=varia, clip=True)).cuda().float().to(device)
-                    seqn=torch.cat([seqn1,seqn2],0)
-                    noise=seqn-seq
-                    noisestd=torch.std(noise, unbiased=False).to(device)
-#                    sys.exit()
-                     
+		if args['type_noise']=="gaussian":
+			seqn, noisestd = add_noise(seq.unsqueeze(0), 'gaussian', \
+									   noise_ival=(args['noise_sigma'], args['noise_sigma']))
+			seqn = seqn.squeeze(0)
+			noisestd = noisestd.view(1)
+		else:
+			# one std per frame for the uniform noise, the noise map uses the std of the
+			# noise of the whole sequence
+			seqn, _ = add_noise(seq, args['type_noise'], \
+								noise_ival=args['uniform_noise_ival'], \
+								poisson_peak=args['poisson_peak'], \
+								speckle_var=args['speckle_var'])
+			noisestd = torch.std(seqn - seq, unbiased=False).view(1)
 
 		denframes = denoise_seq_fastdvdnet(seq=seqn,\
 										noise_std=noisestd,\
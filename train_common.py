@@ -14,8 +14,9 @@ import os
 import time
 import torch
 import torchvision.utils as tutils
-from utils import batch_psnr
-from fastdvdnet import denoise_seq_fastdvdnet
+from metrics import batch_psnr
+from fastdvdnet import denoise_seq_fastdvdnet, frames_to_float, unwrap_model
+from utils import remove_dataparallel_wrapper, add_dataparallel_wrapper
 
 def	resume_training(argdict, model, optimizer):
 	""" Resumes previous training or starts anew
@@ -23,9 +24,13 @@ def	resume_training(argdict, model, optimizer):
 	if argdict['resume_training']:
 		resumef = os.path.join(argdict['log_dir'], 'ckpt.pth')
 		if os.path.isfile(resumef):
-			checkpoint = torch.load(resumef)
+			checkpoint = torch.load(resumef, map_location='cpu')
 			print("> Resuming previous training")
-			model.load_state_dict(checkpoint['state_dict'])
+			# checkpoints may come from a DataParallel (GPU) or a plain (CPU) model
+			state_dict = checkpoint['state_dict']
+			if all(k.startswith('module.') for k in state_dict.keys()):
+				state_dict = remove_dataparallel_wrapper(state_dict)
+			unwrap_model(model).load_state_dict(state_dict)
 			optimizer.load_state_dict(checkpoint['optimizer'])
 			new_epoch = argdict['epochs']
 			new_milestone = argdict['milestone']
@@ -57,6 +62,7 @@ def	resume_training(argdict, model, optimizer):
 		start_epoch = 0
 		training_params = {}
 		training_params['step'] = 0
+		training_params['start_offset'] = 0
 		training_params['current_lr'] = 0
 		training_params['no_orthog'] = argdict['no_orthog']
 
@@ -93,20 +99,24 @@ def	log_train_psnr(result, imsource, loss, writer, epoch, idx, num_minibatches,
 	print("[epoch {}][{}/{}] loss: {:1.4f} PSNR_train: {:1.4f}".\
 		  format(epoch+1, idx+1, num_minibatches, loss.item(), 0.0))
 
-def save_model_checkpoint(model, argdict, optimizer, train_pars, epoch):
+def save_model_checkpoint(model, argdict, optimizer, train_pars, epoch, epoch_end=True):
 	"""Stores the model parameters under 'argdict['log_dir'] + '/net.pth'
-	Also saves a checkpoint under 'argdict['log_dir'] + '/ckpt.pth'
+	Also saves a checkpoint under 'argdict['log_dir'] + '/ckpt.pth', and under
+	'ckpt_e<epoch>.pth' every argdict['save_every_epochs'] epochs if epoch_end
+	The parameters are always saved with the "module." keys of DataParallel, whether
+	the model was trained on GPU or CPU
 	"""
-	torch.save(model.state_dict(), os.path.join(argdict['log_dir'], 'net.pth'))
+	state_dict = add_dataparallel_wrapper(unwrap_model(model).state_dict())
+	torch.save(state_dict, os.path.join(argdict['log_dir'], 'net.pth'))
 	save_dict = { \
-		'state_dict': model.state_dict(), \
+		'state_dict': state_dict, \
 		'optimizer' : optimizer.state_dict(), \
 		'training_params': train_pars, \
 		'args': argdict\
 		}
 	torch.save(save_dict, os.path.join(argdict['log_dir'], 'ckpt.pth'))
 
-	if epoch % argdict['save_every_epochs'] == 0:
+	if epoch_end and epoch % argdict['save_every_epochs'] == 0:
 		torch.save(save_dict, os.path.join(argdict['log_dir'], 'ckpt_e{}.pth'.format(epoch+1)))
 	del save_dict
 
@@ -116,17 +126,19 @@ def validate_and_log(model_temp, dataset_val, valnoisestd, temp_psz, writer, \
 	"""
 	t1 = time.time()
 	psnr_val = 0
+	device = next(model_temp.parameters()).device
 	with torch.no_grad():
 		for seq_val in dataset_val:
+			seq_val = frames_to_float(seq_val)
 			noise = torch.FloatTensor(seq_val.size()).normal_(mean=0, std=valnoisestd)
 			seqn_val = seq_val + noise
-			seqn_val = seqn_val.cuda()
-			sigma_noise = torch.cuda.FloatTensor([valnoisestd])
+			seqn_val = seqn_val.to(device)
+			sigma_noise = torch.FloatTensor([valnoisestd]).to(device)
 			out_val = denoise_seq_fastdvdnet(seq=seqn_val, \
 											noise_std=sigma_noise, \
 											temp_psz=temp_psz,\
 											model_temporal=model_temp)
-			psnr_val += batch_psnr(out_val.cpu(), seq_val.squeeze_(), 1.)
+			psnr_val += batch_psnr(out_val, seq_val.squeeze_(), 1.)
 		psnr_val /= len(dataset_val)
 		t2 = time.time()
 		print("\n[epoch %d] PSNR_val: %.4f, on %.2f sec" % (epoch+1, psnr_val, (t2-t1)))
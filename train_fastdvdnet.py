@@ -16,32 +16,54 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from models import FastDVDnet
-from dataset import ValDataset
-from dataloaders import train_dali_loader
-from utils import svd_orthogonalization, close_logger, init_logging, normalize_augment
+from dataset import ValDataset, LazyValDataset, VALCACHEMB
+from dataloaders import train_dali_loader, train_cpu_loader
+from patch_store import train_patch_loader
+from noise_models import add_noise, get_generator, NOISE_TYPES
+from utils import svd_orthogonalization, close_logger, init_logging, normalize_augment, \
+				FRAME_CACHE_DIR
 from train_common import resume_training, lr_scheduler, log_train_psnr, \
 					validate_and_log, save_model_checkpoint
 
-import numpy as np
-import matplotlib.pyplot as plt
-import sys
-from skimage.util import random_noise
-
-
 def main(**args):
 	r"""Performs the main training loop
 	"""
 
 	# Load dataset
 	print('> Loading datasets ...')
-	dataset_val = ValDataset(valsetdir=args['valset_dir'], gray_mode=False)
-	loader_train = train_dali_loader(batch_size=args['batch_size'],\
-									file_root=args['trainset_dir'],\
-									sequence_length=args['temp_patch_size'],\
-									crop_size=args['patch_size'],\
-									epoch_size=args['max_number_patches'],\
-									random_shuffle=True,\
-									temp_stride=3)
+	if args['val_cache_mb'] is None:
+		dataset_val = ValDataset(valsetdir=args['valset_dir'], gray_mode=False, uint8=True, \
+								 cache_dir=args['frame_cache'])
+	else:
+		# decode the validation sequences on demand, within a memory budget
+		dataset_val = LazyValDataset(valsetdir=args['valset_dir'], gray_mode=False, uint8=True, \
+									 cache_dir=args['frame_cache'], \
+									 max_bytes=int(args['val_cache_mb']*2**20))
+	if args['patch_store'] is not None:
+		# read pre-extracted patches, in a reproducible order
+		loader_train = train_patch_loader(batch_size=args['batch_size'],\
+										  patch_dir=args['patch_store'],\
+										  epoch_size=args['max_number_patches'],\
+										  sequence_length=args['temp_patch_size'],\
+										  crop_size=args['patch_size'])
+	elif args['cpu_loader']:
+		# decode the training sequences on CPU worker processes
+		loader_train = train_cpu_loader(batch_size=args['batch_size'],\
+										file_root=args['trainset_dir'],\
+										sequence_length=args['temp_patch_size'],\
+										crop_size=args['patch_size'],\
+										epoch_size=args['max_number_patches'],\
+										random_shuffle=True,\
+										temp_stride=3,\
+										num_workers=args['loader_workers'])
+	else:
+		loader_train = train_dali_loader(batch_size=args['batch_size'],\
+										file_root=args['trainset_dir'],\
+										sequence_length=args['temp_patch_size'],\
+										crop_size=args['patch_size'],\
+										epoch_size=args['max_number_patches'],\
+										random_shuffle=True,\
+										temp_stride=3)
 
 	num_minibatches = int(args['max_number_patches']//args['batch_size'])
 	ctrl_fr_idx = (args['temp_patch_size'] - 1) // 2
@@ -51,26 +73,46 @@ def main(**args):
 	writer, logger = init_logging(args)
 
 	# Define GPU devices
-	device_ids = [0]
-	torch.backends.cudnn.benchmark = True # CUDNN optimization
-
-	# Create model
-	model = FastDVDnet()
-	model = nn.DataParallel(model, device_ids=device_ids).cuda()
+	if args['cuda']:
+		device = torch.device('cuda')
+		device_ids = [0]
+		torch.backends.cudnn.benchmark = True # CUDNN optimization
+	else:
+		device = torch.device('cpu')
+
+	# Create model, its temporal window is the temporal patch size
+	model = FastDVDnet(num_input_frames=args['temp_patch_size'])
+	if args['cuda']:
+		model = nn.DataParallel(model, device_ids=device_ids).cuda()
 
 	# Define loss
 	criterion = nn.MSELoss(reduction='sum')
-	criterion.cuda()
+	criterion.to(device)
 
 	# Optimizer
 	optimizer = optim.Adam(model.parameters(), lr=args['lr'])
 
 	# Resume training or start anew
 	start_epoch, training_params = resume_training(args, model, optimizer)
+	# samples of start_epoch already used (only the patch store can skip them)
+	start_offset = training_params.get('start_offset', 0)
+	if args['patch_store'] is not None:
+		loader_train.set_epoch(start_epoch, start_offset)
+	elif start_offset:
+		print('> Restarting epoch {} from its first sample'.format(start_epoch+1))
+
+	# Generator of the training noise (None if not seeded). It is reseeded from the epoch
+	# and the sample offset at the start of every epoch and at every checkpoint, so that
+	# a resumed epoch draws the same noise as an uninterrupted one
+	noise_gen = get_generator(args['noise_seed'], device)
+	def reseed_noise(epoch, offset):
+		if noise_gen is not None:
+			noise_gen.manual_seed((args['noise_seed'] * 100003 + epoch) * 100003 + offset)
 
 	# Training
 	start_time = time.time()
 	for epoch in range(start_epoch, args['epochs']):
+
 		# Set learning rate
 		current_lr, reset_orthog = lr_scheduler(epoch, args)
 		if reset_orthog:
@@ -82,7 +124,8 @@ def main(**args):
 		print('\nlearning rate %f' % current_lr)
 
 		# train
-
+		sample_offset = start_offset if epoch == start_epoch and args['patch_store'] is not None else 0
+		reseed_noise(epoch, sample_offset)
 		for i, data in enumerate(loader_train, 0):
 
 			# Pre-training step
@@ -93,7 +136,7 @@ def main(**args):
 
 			# convert inp to [N, num_frames*C. H, W] in  [0., 1.] from [N, num_frames, C. H, W] in [0., 255.]
 			# extract ground truth (central frame)
-			img_train, gt_train = normalize_augment(data[0]['data'], ctrl_fr_idx)
+			img_train, gt_train = normalize_augment(data[0]['data'].to(device), ctrl_fr_idx)
 			
 #			plt.imshow(gt_train[1,:,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
 #			plt.savefig("/content/gdrive/My Drive/projet_7/savefig0.png")
@@ -105,69 +148,19 @@ def main(**args):
 #			plt.savefig("/content/gdrive/My Drive/projet_7/savefig1ter.png")
 #			plt.show()
 			N, L, H, W = img_train.size()
-			
-			if args['type_noise']=="gaussian":
-                # std dev of each sequence
-                                    stdn = torch.empty((N, 1, 1, 1)).cuda().uniform_(args['noise_ival'][0], to=args['noise_ival'][1])
-                # draw noise samples from std dev tensor
-                                    noise = torch.zeros_like(img_train)
-                                    noise = torch.normal(mean=noise, std=stdn.expand_as(noise))
-                #define noisy input
-                                    imgn_train = img_train + noise
-#                                    plt.imshow(imgn_train[1,0:3,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-#                                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig1_gauss.png")
-#                                    sys.exit()
-                                    
-			if args['type_noise']=="uniform":
-# std dev of each sequence
-                                    stdn = torch.empty((N, 1, 1, 1)).cuda().uniform_(args['noise_ival'][0], to=args['noise_ival'][1])
-# draw noise samples from std dev tensor
-                                    v_max=np.sqrt(3)*stdn
-                                    noise = torch.empty((N,L,H,W)).cuda().uniform(-1,to=1)
-                                    # Pytorch accept? 
-                                    noise = noise*stdn.expand_as(noise)
-                                    noise2 = torch.empty((N,L,H,W)).cuda().uniform(-1,to=1)*stdn.expand_as(noise)*np.sqrt(3).cuda()
-                                    for img_du_batch in range(N):
-                                        noise2[img_du_batch,:,:,:] = noise[img_du_batch,:,:,:]*v_max[img_du_batch,1,1,1]
-                                    print(noise-noise2)
-
-			if args['type_noise']=="poisson":
-                                    peak=args['poisson_peak']
-                                    imgn_train = torch.poisson(img_train /255 * peak ) / float(peak) *255
-                                    noise=imgn_train-img_train
-                                    std=torch.std(noise,unbiased=True)
-                                    mean=torch.mean(noise)
-                                    stdn = torch.empty((N, 1, 1, 1)).cuda().normal_(mean=mean,std=std)
-                                    plt.imshow(imgn_train[1,0:3,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-                                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig1_poisson.png")
-                                    sys.exit()
-			if args['type_noise']=="s&p":
-                                    s_vs_p = 0.5
-                                    # Salt mode
-                                    imgn_train = torch.tensor(random_noise(img_train.cpu(), mode='s&p', salt_vs_pepper=s_vs_p, clip=True)).cuda()
-                                    noise=imgn_train-img_train
-                                    stdn = torch.empty((N, 1, 1, 1)).cuda()
-                                    for img_du_batch in range(N):
-                                        stdn[img_du_batch,:,:,:]=torch.std(noise[img_du_batch,:,:,:],unbiased=True) 
-#                                    plt.imshow(imgn_train[1,0:3,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-#                                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig1_s&p.png")
-#                                    sys.exit()
-                                    
-			if args['type_noise']=="speckle":
-                                    varia=args['speckle_var']
-                                    imgn_train = torch.tensor(random_noise(img_train.cpu(), mode='speckle', mean=0, var=varia, clip=True)).cuda().float()
-                                    noise=imgn_train-img_train
-                                    stdn = torch.empty((N, 1, 1, 1)).cuda()
-                                    for img_du_batch in range(N):
-                                        stdn[img_du_batch,:,:,:]=torch.std(noise[img_du_batch,:,:,:],unbiased=True) 
-#                                    plt.imshow(imgn_train[1,0:3,:,:].unsqueeze(0).cuda().detach().cpu().clone().numpy().swapaxes(0,3).swapaxes(1,2).squeeze())
-#                                    plt.savefig("/content/gdrive/My Drive/projet_7/savefig1_speckle.png")
-#                                    sys.exit()                        
+
+			# std dev of each sequence and noisy input
+			imgn_train, stdn = add_noise(img_train, args['type_noise'], \
+										 noise_ival=args['noise_ival'], \
+										 poisson_peak=args['poisson_peak'], \
+										 sp_amount=args['sp_amount'], \
+										 speckle_var=args['speckle_var'], \
+										 generator=noise_gen)
+
 			# Send tensors to GPU
-			gt_train = gt_train.cuda(non_blocking=True)
-			imgn_train = imgn_train.cuda(non_blocking=True)
-			noise = noise.cuda(non_blocking=True)
-			noise_map = stdn.expand((N, 1, H, W)).cuda(non_blocking=True) # one channel per image
+			gt_train = gt_train.to(device, non_blocking=True)
+			imgn_train = imgn_train.to(device, non_blocking=True)
+			noise_map = stdn.expand((N, 1, H, W)).to(device, non_blocking=True) # one channel per image
 
 			# Evaluate model and optimize it
 			out_train = model(imgn_train, noise_map)
@@ -194,6 +187,14 @@ def main(**args):
 								training_params)
 			# update step counter
 			training_params['step'] += 1
+			sample_offset += N
+
+			# save a checkpoint within the epoch, resumed from sample_offset
+			if args['save_every_steps'] and training_params['step'] % args['save_every_steps'] == 0:
+				training_params['start_epoch'] = epoch
+				training_params['start_offset'] = sample_offset
+				save_model_checkpoint(model, args, optimizer, training_params, epoch, epoch_end=False)
+				reseed_noise(epoch, sample_offset)
 
 		# Call to model.eval() to correctly set the BN layers before inference
 		model.eval()
@@ -219,6 +220,7 @@ def main(**args):
 
 		# save model and checkpoint
 		training_params['start_epoch'] = epoch + 1
+		training_params['start_offset'] = 0
 		save_model_checkpoint(model, args, optimizer, training_params, epoch)
 
 	# Print elapsed time
@@ -250,15 +252,22 @@ if __name__ == "__main__":
 						orthogonalization")
 	parser.add_argument("--save_every_epochs", type=int, default=5,\
 						help="Number of training epochs to save state")
+	parser.add_argument("--save_every_steps", type=int, default=0,\
+						help="Number of training steps to save a checkpoint within the epochs (0: never). "\
+						"Training resumes from the next sample with --patch_store")
 ###########################
 #  AJOUT                  #	
 ###########################
-	parser.add_argument("--type_noise", type=str, default="gaussian", \
-                        help="type of the noise:gaussian,s&p,poisson")
+	parser.add_argument("--type_noise", type=str, default="gaussian", choices=NOISE_TYPES, \
+                        help="type of the noise: {}".format(', '.join(NOISE_TYPES)))
 	parser.add_argument("--poisson_peak", type=float, default=25.0, \
                         help="peak of the poisson noise")
 	parser.add_argument("--speckle_var", type=float, default=0.05, \
                         help="variance of the speckle function")
+	parser.add_argument("--sp_amount", type=float, default=0.05, \
+						help="proportion of values replaced by the salt and pepper noise")
+	parser.add_argument("--noise_seed", type=int, default=None, \
+						help="seed of the training noise (reseeded at every epoch and checkpoint)")
 ###########################
 	parser.add_argument("--noise_ival", nargs=2, type=int, default=[5, 55], \
 					 help="Noise training interval")
@@ -266,7 +275,7 @@ if __name__ == "__main__":
 						help='noise level used on validation set')
 	# Preprocessing parameters
 	parser.add_argument("--patch_size", "--p", type=int, default=96, help="Patch size")
-	parser.add_argument("--temp_patch_size", "--tp", type=int, default=5, help="Temporal patch size")
+	parser.add_argument("--temp_patch_size", "--tp", type=int, default=5, help="Temporal patch size, i.e. size of the temporal window of the model (odd)")
 	parser.add_argument("--max_number_patches", "--m", type=int, default=256000, \
 						help="Maximum number of patches")
 	# Dirs
@@ -276,8 +285,27 @@ if __name__ == "__main__":
 					 help='path of trainset')
 	parser.add_argument("--valset_dir", type=str, default=None, \
 						 help='path of validation set')
+	parser.add_argument("--cpu_loader", action='store_true', \
+						help='decode the training sequences (videos or image folders) on CPU '\
+						'instead of with DALI on GPU')
+	parser.add_argument("--loader_workers", type=int, default=4, \
+						help='number of processes of the CPU loader')
+	parser.add_argument("--no_gpu", action='store_true', help="train on CPU")
+	parser.add_argument("--patch_store", type=str, default=None, \
+						help='path of a patch store written by patch_store.py, used instead of '\
+						'decoding the trainset')
+	parser.add_argument("--frame_cache", type=str, nargs='?', default=None, \
+						const=FRAME_CACHE_DIR, \
+						help='memory-map the decoded validation sequences from a cache in this '\
+						'directory (default: {})'.format(FRAME_CACHE_DIR))
+	parser.add_argument("--val_cache_mb", type=float, nargs='?', default=None, const=VALCACHEMB, \
+						help='decode the validation sequences on demand, keeping at most this '\
+						'many MB of them in memory (default: {})'.format(VALCACHEMB))
 	argspar = parser.parse_args()
 
+	# use CUDA?
+	argspar.cuda = not argspar.no_gpu and torch.cuda.is_available()
+
 	# Normalize noise between [0, 1]
 	argspar.val_noiseL /= 255.
 	argspar.noise_ival[0] /= 255.
@@ -14,8 +14,10 @@ this program. If not, see <http://www.gnu.org/licenses/>.
 import os
 import subprocess
 import glob
+import json
+import hashlib
 import logging
-from random import choices # requires Python >= 3.6
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 import torch
@@ -23,53 +25,57 @@ from skimage.measure.simple_metrics import compare_psnr
 from tensorboardX import SummaryWriter
 
 IMAGETYPES = ('*.bmp', '*.png', '*.jpg', '*.jpeg', '*.tif') # Supported image types
+FRAME_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'fastdvdnet', 'frames')
+
+# Augmentations of normalize_augment(): do_nothing, flipud, rot90, rot90_flipud, rot180,
+# rot180_flipud, rot270, rot270_flipud, add_csnt. Each geometric one maps the output pixel
+# (i, j) to the input pixel (a, b), with (a, b) = (j, i) if swap else (i, j), then
+# a = H-1-a if flip_i and b = W-1-b if flip_j (same results as torch.flip/torch.rot90).
+AUG_TABLE = ((0, 0, 0), (0, 1, 0), (1, 0, 1), (1, 0, 0), \
+			 (0, 1, 1), (0, 0, 1), (1, 1, 0), (1, 1, 1), (0, 0, 0)) # (swap, flip_i, flip_j)
+AUG_WEIGHTS = (32, 12, 12, 12, 12, 12, 12, 12, 12) # one fourth chances to do_nothing
+AUG_CSNT = 8 # index of add_csnt, which adds a constant to the whole patch
+AUG_CSNT_STD = 5/255. # std of the constant of add_csnt
 
 def normalize_augment(datain, ctrl_fr_idx):
 	'''Normalizes and augments an input patch of dim [N, num_frames, C. H, W] in [0., 255.] to \
 		[N, num_frames*C. H, W] in  [0., 1.]. It also returns the central frame of the temporal \
 		patch as a ground truth.
+		A transformation is drawn independently for each patch of the batch, and all of them
+		are applied at once with a single gather on the device of datain. Transformations
+		swapping the spatial axes are only drawn for square patches.
 	'''
-	def transform(sample):
-		# define transformations
-		do_nothing = lambda x: x
-		do_nothing.__name__ = 'do_nothing'
-		flipud = lambda x: torch.flip(x, dims=[2])
-		flipud.__name__ = 'flipup'
-		rot90 = lambda x: torch.rot90(x, k=1, dims=[2, 3])
-		rot90.__name__ = 'rot90'
-		rot90_flipud = lambda x: torch.flip(torch.rot90(x, k=1, dims=[2, 3]), dims=[2])
-		rot90_flipud.__name__ = 'rot90_flipud'
-		rot180 = lambda x: torch.rot90(x, k=2, dims=[2, 3])
-		rot180.__name__ = 'rot180'
-		rot180_flipud = lambda x: torch.flip(torch.rot90(x, k=2, dims=[2, 3]), dims=[2])
-		rot180_flipud.__name__ = 'rot180_flipud'
-		rot270 = lambda x: torch.rot90(x, k=3, dims=[2, 3])
-		rot270.__name__ = 'rot270'
-		rot270_flipud = lambda x: torch.flip(torch.rot90(x, k=3, dims=[2, 3]), dims=[2])
-		rot270_flipud.__name__ = 'rot270_flipud'
-		add_csnt = lambda x: x + torch.normal(mean=torch.zeros(x.size()[0], 1, 1, 1), \
-								 std=(5/255.)).expand_as(x).to(x.device)
-		add_csnt.__name__ = 'add_csnt'
-
-		# define transformations and their frequency, then pick one.
-		aug_list = [do_nothing, flipud, rot90, rot90_flipud, \
-					rot180, rot180_flipud, rot270, rot270_flipud, add_csnt]
-		w_aug = [32, 12, 12, 12, 12, 12, 12, 12, 12] # one fourth chances to do_nothing
-		transf = choices(aug_list, w_aug)
-
-		# transform all images in array
-		return transf[0](sample)
-
-	img_train = datain
-	# convert to [N, num_frames*C. H, W] in  [0., 1.] from [N, num_frames, C. H, W] in [0., 255.]
-	img_train = img_train.view(img_train.size()[0], -1, \
-							   img_train.size()[-2], img_train.size()[-1]) / 255.
+	N, F, C, H, W = datain.size()
+	device = datain.device
+
+	# draw one transformation per patch
+	weights = torch.tensor(AUG_WEIGHTS, dtype=torch.float, device=device)
+	table = torch.tensor(AUG_TABLE, dtype=torch.long, device=device)
+	if H != W:
+		weights = weights * (1 - table[:, 0])
+	aug = torch.multinomial(weights, N, replacement=True)
+	swap, flip_i, flip_j = table[aug].view(N, 3, 1, 1).unbind(1)
+
+	# source pixel of every output pixel, [N, H, W]
+	ii = torch.arange(H, device=device).view(1, H, 1)
+	jj = torch.arange(W, device=device).view(1, 1, W)
+	src_i = torch.where(swap.bool(), jj, ii)
+	src_j = torch.where(swap.bool(), ii, jj)
+	src_i = torch.where(flip_i.bool(), H-1-src_i, src_i)
+	src_j = torch.where(flip_j.bool(), W-1-src_j, src_j)
+	src_idx = (src_i*W + src_j).view(N, 1, H*W).expand(N, F*C, H*W)
+
+	# constant added to the whole patch by add_csnt
+	offset = torch.randn((N, 1, 1, 1), device=device) * AUG_CSNT_STD
+	offset = offset * (aug == AUG_CSNT).view(N, 1, 1, 1)
 
-	#augment
-	img_train = transform(img_train)
+	# convert to [N, num_frames*C. H, W] in  [0., 1.] from [N, num_frames, C. H, W] in [0., 255.]
+	# while applying the transformations
+	img_train = datain.reshape(N, F*C, H*W).gather(2, src_idx).view(N, F*C, H, W)
+	img_train = torch.add(offset, img_train, alpha=1/255.)
 
 	# extract ground truth (central frame)
-	gt_train = img_train[:, 3*ctrl_fr_idx:3*ctrl_fr_idx+3, :, :]
+	gt_train = img_train[:, C*ctrl_fr_idx:C*ctrl_fr_idx+C, :, :]
 	return img_train, gt_train
 
 def init_logging(argdict):
@@ -99,7 +105,22 @@ def get_imagenames(seq_dir, pattern=None):
 	files.sort(key=lambda f: int(''.join(filter(str.isdigit, f))))
 	return files
 
-def open_sequence(seq_dir, gray_mode, expand_if_needed=False, max_num_fr=100):
+def get_frame_cache_key(seq_dir, files, gray_mode, expand_if_needed, uint8):
+	r"""Returns the key of the decoded sequence of the frames files of seq_dir in
+	the frame cache. It changes if any file is added, removed or modified.
+	"""
+	sha = hashlib.sha256()
+	desc = {'seq_dir': os.path.abspath(seq_dir), \
+			'files': [(os.path.basename(f), os.stat(f).st_mtime_ns, os.stat(f).st_size) \
+					  for f in files], \
+			'gray_mode': bool(gray_mode), \
+			'expand_if_needed': bool(expand_if_needed), \
+			'uint8': bool(uint8)}
+	sha.update(json.dumps(desc, sort_keys=True).encode('utf-8'))
+	return sha.hexdigest()[:24]
+
+def open_sequence(seq_dir, gray_mode, expand_if_needed=False, max_num_fr=100, num_workers=None, \
+				  uint8=False, cache_dir=None):
 	r""" Opens a sequence of images and expands it to even sizes if necesary
 	Args:
 		fpath: string, path to image sequence
@@ -108,25 +129,84 @@ def open_sequence(seq_dir, gray_mode, expand_if_needed=False, max_num_fr=100):
 			size is odd
 		expand_axis0: if True, output will have a fourth dimension
 		max_num_fr: maximum number of frames to load
+		num_workers: number of threads decoding the frames (default: number of CPUs)
+		uint8: if True, the frames are kept as uint8 in the range [0, 255] (4x
+			smaller than float32)
+		cache_dir: if not None, directory of the cache of decoded sequences. The
+			decoded sequence is stored there as a .npy file with a .json file of
+			metadata. If it was decoded before, a (copy-on-write) memory-mapped
+			view of it is returned without decoding any frame
 	Returns:
 		seq: array of dims [num_frames, C, H, W], C=1 grayscale or C=3 RGB, H and W are even.
-			The image gets normalized gets normalized to the range [0, 1].
+			The image gets normalized gets normalized to the range [0, 1] (unless uint8).
 		expanded_h: True if original dim H was odd and image got expanded in this dimension.
 		expanded_w: True if original dim W was odd and image got expanded in this dimension.
 	"""
 	# Get ordered list of filenames
-	files = get_imagenames(seq_dir)
+	files = get_imagenames(seq_dir)[0:max_num_fr]
 
-	seq_list = []
 	print("\tOpen sequence in folder: ", seq_dir)
-	for fpath in files[0:max_num_fr]:
-
-		img, expanded_h, expanded_w = open_image(fpath,\
-												   gray_mode=gray_mode,\
-												   expand_if_needed=expand_if_needed,\
-												   expand_axis0=False)
-		seq_list.append(img)
-	seq = np.stack(seq_list, axis=0)
+	if cache_dir is not None:
+		key = get_frame_cache_key(seq_dir, files, gray_mode, expand_if_needed, uint8)
+		cache_file = os.path.join(cache_dir, key + '.npy')
+		meta_file = os.path.join(cache_dir, key + '.json')
+		# the metadata file is written last, once the array is complete
+		if os.path.isfile(meta_file) and os.path.isfile(cache_file):
+			with open(meta_file, 'r') as f:
+				meta = json.load(f)
+			return np.load(cache_file, mmap_mode='c'), meta['expanded_h'], meta['expanded_w']
+
+	def load_frame(fpath):
+		return open_image(fpath,\
+						  gray_mode=gray_mode,\
+						  expand_if_needed=expand_if_needed,\
+						  expand_axis0=False,\
+						  normalize_data=not uint8)
+
+	# the first frame gives the size of the preallocated sequence
+	img, expanded_h, expanded_w = load_frame(files[0])
+	C = 1 if gray_mode else 3
+	shape = (len(files), C) + img.shape[-2:]
+	if cache_dir is not None:
+		# decode straight into the cache file
+		if not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+		tmp_file = '{}.{}.tmp.npy'.format(os.path.join(cache_dir, key), os.getpid())
+		seq = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=img.dtype, shape=shape)
+	else:
+		seq = np.empty(shape, dtype=img.dtype)
+	seq[0] = img.reshape(seq.shape[1:])
+
+	def decode_into(idx):
+		# cv2 releases the GIL while decoding, so that frames are decoded in parallel
+		img, _, _ = load_frame(files[idx])
+		if img.shape[-2:] != seq.shape[-2:]:
+			raise Exception('Frame {} has size {}, expected {}'.\
+							format(files[idx], img.shape[-2:], seq.shape[-2:]))
+		seq[idx] = img.reshape(seq.shape[1:])
+
+	if num_workers is None:
+		num_workers = os.cpu_count()
+	if num_workers > 1 and len(files) > 2:
+		with ThreadPoolExecutor(max_workers=num_workers) as pool:
+			list(pool.map(decode_into, range(1, len(files))))
+	else:
+		for idx in range(1, len(files)):
+			decode_into(idx)
+
+	if cache_dir is not None:
+		# move the complete array into the cache, then write its metadata
+		seq.flush()
+		del seq
+		os.replace(tmp_file, cache_file)
+		meta = {'seq_dir': os.path.abspath(seq_dir), 'shape': list(shape), \
+				'dtype': str(np.dtype(img.dtype)), \
+				'expanded_h': expanded_h, 'expanded_w': expanded_w}
+		tmp_file = '{}.{}.tmp'.format(meta_file, os.getpid())
+		with open(tmp_file, 'w') as f:
+			json.dump(meta, f)
+		os.replace(tmp_file, meta_file)
+		seq = np.load(cache_file, mmap_mode='c')
 	return seq, expanded_h, expanded_w
 
 def open_image(fpath, gray_mode, expand_if_needed=False, expand_axis0=True, normalize_data=True):
@@ -138,6 +218,8 @@ def open_image(fpath, gray_mode, expand_if_needed=False, expand_axis0=True, norm
 		expand_if_needed: if True, the spatial dimensions will be expanded if
 			size is odd
 		expand_axis0: if True, output will have a fourth dimension
+		normalize_data: if True, the image is normalized to float32 in the range
+			[0, 1]. Otherwise it is kept as uint8
 	Returns:
 		img: image of dims NxCxHxW, N=1, C=1 grayscale or C=3 RGB, H and W are even.
 			if expand_axis0=False, the output will have a shape CxHxW.
@@ -304,7 +386,8 @@ def normalize(data):
 	Args:
 		data: a unint8 numpy array to normalize from [0, 255] to [0, 1]
 	"""
-	return np.float32(data/255.)
+	# the float32 division is exact up to rounding, no float64 intermediate is needed
+	return data.astype(np.float32) / np.float32(255.)
 
 def svd_orthogonalization(lyr):
 	r"""Applies regularization to the training by performing the
@@ -354,3 +437,36 @@ def remove_dataparallel_wrapper(state_dict):
 		new_state_dict[name] = v
 
 	return new_state_dict
+
+def add_dataparallel_wrapper(state_dict):
+	r"""Adds the "module." wrapper of DataParallel to the keys of the state
+	dictionary of a normal model, see remove_dataparallel_wrapper()
+
+	Args:
+		state_dict: a torch.nn.Module state dictionary
+	"""
+	from collections import OrderedDict
+
+	new_state_dict = OrderedDict()
+	for k, v in state_dict.items():
+		new_state_dict['module.' + k] = v
+
+	return new_state_dict
+
+def load_checkpoint_state_dict(model_file, map_location=None):
+	r"""Loads the state dictionary of a model saved by train_fastdvdnet.py
+
+	Both the model files ('net.pth') and the training checkpoints ('ckpt*.pth')
+	are supported. The "module." wrapper of DataParallel is removed if present.
+
+	Args:
+		model_file: path to the model file or checkpoint
+		map_location: passed to torch.load
+	"""
+	state_dict = torch.load(model_file, map_location=map_location)
+	if 'state_dict' in state_dict:
+		state_dict = state_dict['state_dict']
+	if all(k.startswith('module.') for k in state_dict.keys()):
+		state_dict = remove_dataparallel_wrapper(state_dict)
+
+	return state_dict
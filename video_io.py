@@ -0,0 +1,130 @@
+"""
+Streaming input and output of video files.
+
+Frames are decoded one at a time with OpenCV and encoded through a pipe to a local
+ffmpeg (or with OpenCV if ffmpeg is not available), so that no intermediate image
+file is written and only a few frames are held in memory.
+
+This program is free software: you can use, modify and/or
+redistribute it under the terms of the GNU General Public
+License as published by the Free Software Foundation, either
+version 3 of the License, or (at your option) any later
+version. You should have received a copy of this license along
+this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import shutil
+import subprocess
+import numpy as np
+import cv2
+
+VIDEOEXT = ('.mp4', '.mkv', '.avi', '.mov', '.webm') # video files read by test_fastdvdnet.py
+
+def is_video_file(path):
+	'''Returns True if path is a file with a video extension
+	'''
+	return os.path.isfile(path) and path.lower().endswith(VIDEOEXT)
+
+def get_video_fps(path, default=25.):
+	'''Returns the frame rate of the video file path
+	'''
+	cap = cv2.VideoCapture(path)
+	fps = cap.get(cv2.CAP_PROP_FPS)
+	cap.release()
+	return fps if fps > 0 else default
+
+def get_video_num_frames(path):
+	'''Returns the number of frames of the video file path, as stored in its
+		container (it may be approximate, 0 if unknown)
+	'''
+	cap = cv2.VideoCapture(path)
+	num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+	cap.release()
+	return max(num_frames, 0)
+
+def read_video_frames(path, gray_mode=False, max_num_fr=None):
+	r"""Decodes the frames of a video file one at a time.
+
+	Args:
+		path: path of the video file
+		gray_mode: if True, frames are converted to grayscale
+		max_num_fr: if not None, maximum number of frames to read
+	Yields:
+		frame: uint8 array [C, H, W], C=1 grayscale or C=3 RGB
+	"""
+	cap = cv2.VideoCapture(path)
+	if not cap.isOpened():
+		raise Exception('Could not open video {}'.format(path))
+	num_frames = 0
+	try:
+		while max_num_fr is None or num_frames < max_num_fr:
+			ret, frame = cap.read()
+			if not ret:
+				break
+			if gray_mode:
+				frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)[np.newaxis, :, :]
+			else:
+				frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).transpose(2, 0, 1)
+			num_frames += 1
+			yield frame
+	finally:
+		cap.release()
+
+class VideoWriter():
+	'''Encodes uint8 frames [C, H, W] (C=1 grayscale or C=3 RGB) to a video file,
+	piping them to ffmpeg (H.264) if it is installed, or with cv2.VideoWriter otherwise.
+	The size of the video is the one of the first frame. With ffmpeg, odd heights and
+	widths are padded by one pixel (H.264 in yuv420p needs even sizes).
+	Args:
+		path: (str)
+			Path of the output video file
+		fps: (float)
+			Frame rate
+		crf: (int, optional, default=17)
+			Constant rate factor of the H.264 encoder (0 is lossless)
+	'''
+	def __init__(self, path, fps, crf=17):
+		self.path = path
+		self.fps = fps
+		self.crf = crf
+		self.proc = None
+		self.writer = None
+
+	def open(self, num_channels, height, width):
+		ffmpeg = shutil.which('ffmpeg')
+		if ffmpeg is not None:
+			cmd = [ffmpeg, '-y', '-loglevel', 'error', \
+				   '-f', 'rawvideo', '-pix_fmt', 'gray' if num_channels == 1 else 'rgb24', \
+				   '-s', '{}x{}'.format(width, height), '-r', str(self.fps), '-i', '-', \
+				   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', \
+				   '-c:v', 'libx264', '-crf', str(self.crf), '-pix_fmt', 'yuv420p', self.path]
+			self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+		else:
+			self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, \
+										  (width, height), num_channels == 3)
+
+	def write(self, frame):
+		'''Encodes a uint8 frame [C, H, W]
+		'''
+		if self.proc is None and self.writer is None:
+			self.open(*frame.shape)
+		if self.proc is not None:
+			self.proc.stdin.write(np.ascontiguousarray(frame.transpose(1, 2, 0)).tobytes())
+		elif frame.shape[0] == 3:
+			self.writer.write(cv2.cvtColor(frame.transpose(1, 2, 0), cv2.COLOR_RGB2BGR))
+		else:
+			self.writer.write(frame[0])
+
+	def close(self):
+		if self.proc is not None:
+			self.proc.stdin.close()
+			if self.proc.wait() != 0:
+				raise Exception('ffmpeg failed to encode {}'.format(self.path))
+		if self.writer is not None:
+			self.writer.release()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()